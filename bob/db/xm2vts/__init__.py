@@ -19,8 +19,30 @@
 """This is the Bob database entry for the XM2VTS database
 """
 
-from .query import Database
-from .models import Client, File, Protocol, ProtocolPurpose, Annotation
+# the public classes are imported from their submodules on first access (PEP
+# 562), so that importing this package does not load SQLAlchemy and bob.db.base
+_lazy_attributes = {
+  'Database': '.query',
+  'Client': '.models',
+  'File': '.models',
+  'Protocol': '.models',
+  'ProtocolPurpose': '.models',
+  'Annotation': '.models',
+  'FileRecord': '.records',
+  'ClientRecord': '.records',
+  'SnapshotDatabase': '.snapshot',
+}
+
+def __getattr__(name):
+  if name in _lazy_attributes:
+    import importlib
+    value = getattr(importlib.import_module(_lazy_attributes[name], __name__), name)
+    globals()[name] = value
+    return value
+  raise AttributeError("module '%s' has no attribute '%s'" % (__name__, name))
+
+def __dir__():
+  return sorted(set(globals()) | set(_lazy_attributes))
 
 def get_config():
   """Returns a string containing the configuration information.
@@ -30,4 +52,4 @@ def get_config():
 
 
 # gets sphinx autodoc done right - don't remove it
-__all__ = [_ for _ in dir() if not _.startswith('_')]
+__all__ = sorted(set(_ for _ in globals() if not _.startswith('_')) | set(_lazy_attributes))
@@ -21,199 +21,338 @@
 """
 
 import os
+from sqlalchemy import text
 
 from .models import *
+from .index import COHORT_GROUPS
 
 def nodot(item):
   """Can be used to ignore hidden files, starting with the . character."""
   return item[0] != '.'
 
+# The clients of the XM2VTS database, for each of its groups
+CLIENTS = {
+  'client': [  3,   4,   5,   6,   9,  12,  13,  16,  17,  18,
+              19,  20,  21,  22,  24,  25,  26,  27,  29,  30,
+              32,  33,  34,  35,  36,  37,  38,  40,  41,  42,
+              45,  47,  49,  50,  51,  52,  53,  54,  55,  56,
+              58,  60,  61,  64,  65,  66,  68,  69,  71,  72,
+              73,  74,  75,  78,  79,  80,  82,  85,  89,  90,
+              91,  92,  99, 101, 102, 103, 105, 108, 110, 112,
+             113, 115, 116, 121, 122, 123, 124, 125, 126, 129,
+             132, 133, 135, 136, 137, 138, 140, 141, 145, 146,
+             148, 150, 152, 154, 159, 163, 164, 165, 166, 167,
+             168, 169, 173, 178, 179, 180, 181, 182, 183, 188,
+             191, 193, 196, 197, 198, 206, 207, 208, 209, 210,
+             211, 213, 216, 218, 219, 221, 222, 224, 227, 228,
+             229, 231, 232, 233, 235, 236, 237, 240, 243, 244,
+             246, 248, 249, 253, 255, 258, 259, 261, 264, 266,
+             267, 269, 270, 274, 275, 278, 279, 281, 282, 285,
+             287, 288, 289, 290, 292, 293, 295, 305, 310, 312,
+             316, 319, 320, 321, 322, 324, 325, 328, 329, 330,
+             332, 333, 334, 336, 337, 338, 339, 340, 342, 357,
+             358, 359, 360, 362, 364, 365, 366, 369, 370, 371],
+  'impostorDev': [  0,   2,   7,  46,  57,  62,  83,  93, 104, 120,
+                  143, 157, 158, 177, 187, 189, 203, 212, 215, 242,
+                  276, 284, 301, 314, 331],
+  'impostorEval': [  1,   8,  10,  11,  23,  28,  31,  39,  43,  44,
+                    48,  59,  67,  70,  81,  86,  87,  88,  95,  96,
+                    98, 107, 109, 111, 114, 119, 127, 128, 130, 131,
+                   134, 142, 147, 149, 153, 155, 160, 161, 170, 171,
+                   172, 174, 175, 176, 185, 190, 199, 200, 201, 202,
+                   225, 226, 234, 241, 250, 263, 271, 272, 280, 283,
+                   286, 300, 313, 315, 317, 318, 323, 335, 341, 367],
+}
+
 def add_clients(session, verbose):
   """Add clients to the XM2VTS database."""
-  # clients
-  client_list = [  3,   4,   5,   6,   9,  12,  13,  16,  17,  18,
-                  19,  20,  21,  22,  24,  25,  26,  27,  29,  30,
-                  32,  33,  34,  35,  36,  37,  38,  40,  41,  42,
-                  45,  47,  49,  50,  51,  52,  53,  54,  55,  56,
-                  58,  60,  61,  64,  65,  66,  68,  69,  71,  72,
-                  73,  74,  75,  78,  79,  80,  82,  85,  89,  90,
-                  91,  92,  99, 101, 102, 103, 105, 108, 110, 112,
-                 113, 115, 116, 121, 122, 123, 124, 125, 126, 129,
-                 132, 133, 135, 136, 137, 138, 140, 141, 145, 146,
-                 148, 150, 152, 154, 159, 163, 164, 165, 166, 167,
-                 168, 169, 173, 178, 179, 180, 181, 182, 183, 188,
-                 191, 193, 196, 197, 198, 206, 207, 208, 209, 210,
-                 211, 213, 216, 218, 219, 221, 222, 224, 227, 228,
-                 229, 231, 232, 233, 235, 236, 237, 240, 243, 244,
-                 246, 248, 249, 253, 255, 258, 259, 261, 264, 266,
-                 267, 269, 270, 274, 275, 278, 279, 281, 282, 285,
-                 287, 288, 289, 290, 292, 293, 295, 305, 310, 312,
-                 316, 319, 320, 321, 322, 324, 325, 328, 329, 330,
-                 332, 333, 334, 336, 337, 338, 339, 340, 342, 357,
-                 358, 359, 360, 362, 364, 365, 366, 369, 370, 371]
   if verbose: print("Adding clients...")
-  for cid in client_list:
-    if verbose>1: print("  Adding client '%d' on 'client' group..." % (cid))
-    session.add(Client(cid, 'client'))
-  # impostorDev
-  impostorDev_list = [  0,   2,   7,  46,  57,  62,  83,  93, 104, 120,
-                      143, 157, 158, 177, 187, 189, 203, 212, 215, 242,
-                      276, 284, 301, 314, 331]
-  for cid in impostorDev_list:
-    if verbose>1: print("  Adding client '%d' on 'impostorDev' group..." % (cid))
-    session.add(Client(cid, 'impostorDev'))
-  # impostorEval
-  impostorEval_list = [  1,   8,  10,  11,  23,  28,  31,  39,  43,  44,
-                        48,  59,  67,  70,  81,  86,  87,  88,  95,  96,
-                        98, 107, 109, 111, 114, 119, 127, 128, 130, 131,
-                       134, 142, 147, 149, 153, 155, 160, 161, 170, 171,
-                       172, 174, 175, 176, 185, 190, 199, 200, 201, 202,
-                       225, 226, 234, 241, 250, 263, 271, 272, 280, 283,
-                       286, 300, 313, 315, 317, 318, 323, 335, 341, 367]
-  for cid in impostorEval_list:
-    if verbose>1 : print("  Adding client '%d' on 'impostorEval' group..." % (cid))
-    session.add(Client(cid, 'impostorEval'))
-
-def add_files(session, imagedir, verbose):
-  """Add files to the XM2VTS database."""
-
-  def add_file(session, basename, client_dir, subdir):
-    """Parse a single filename and add it to the list."""
-    v = os.path.splitext(basename)[0].split('_')
-    if(subdir == 'frontal'):
-      session.add(File(int(v[0]), os.path.join(subdir, client_dir, basename), int(v[1]), 'n', int(v[2])))
-    elif(subdir == 'darkened'):
-      session.add(File(int(v[0]), os.path.join(subdir, client_dir, basename), 4, v[2][0], int(v[2][1])))
-
+  rows = []
+  for group in Client.group_choices:
+    for cid in CLIENTS[group]:
+      if verbose>1: print("  Adding client '%d' on '%s' group..." % (cid, group))
+      rows.append({'id': cid, 'sgroup': group})
+  session.execute(Client.__table__.insert(), rows)
+
+def parse_file(basename, client_dir, subdir):
+  """Parses a single filename and returns the corresponding (client_id, path,
+  session_id, darkened, shot_id) row of the File table."""
+  v = os.path.splitext(basename)[0].split('_')
+  if(subdir == 'frontal'):
+    return (int(v[0]), os.path.join(subdir, client_dir, basename), int(v[1]), 'n', int(v[2]))
+  elif(subdir == 'darkened'):
+    return (int(v[0]), os.path.join(subdir, client_dir, basename), 4, v[2][0], int(v[2][1]))
+
+def scan_client_dir(imagedir_app, subdir, cl_dir):
+  """Returns the rows of all images inside the given client directory."""
+  rows = []
+  for entry in os.scandir(os.path.join(imagedir_app, cl_dir)):
+    if nodot(entry.name):
+      basename, extension = os.path.splitext(entry.name)
+      rows.append(parse_file(basename, cl_dir, subdir))
+  return rows
+
+def scan_files(imagedir, verbose, jobs=1):
+  """Scans the image directories of the XM2VTS database and returns the
+  (client_id, path, session_id, darkened, shot_id) rows of all images."""
+
+  from concurrent.futures import ThreadPoolExecutor
+
+  rows = []
   for subdir in ('frontal', 'darkened'):
-    if verbose: print("Adding files of sub-dir '%s'..." % subdir)
+    if verbose: print("Scanning files of sub-dir '%s'..." % subdir)
     imagedir_app = os.path.join(imagedir,subdir)
-    file_list = os.listdir(imagedir_app)
-    for cl_dir in filter(nodot, file_list):
-      if os.path.isdir(os.path.join(imagedir_app, cl_dir)):
-        client_dir = os.path.join(imagedir_app, cl_dir)
-        for filename in filter(nodot, os.listdir(client_dir)):
-          basename, extension = os.path.splitext(filename)
-          if verbose>1: print("  Adding file '%s'..." % (basename))
-          add_file(session, basename, cl_dir, subdir)
-
-def add_annotations(session, annotdir, verbose, only_filename = False):
-  """Reads annotation files of the XM2VTS database and stores the annotations in the sql database."""
+    client_dirs = [e.name for e in os.scandir(imagedir_app) if nodot(e.name) and e.is_dir()]
+    # the client directories are scanned in parallel, but the rows are kept in
+    # the order of the directory listing
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+      for client_rows in executor.map(lambda cl_dir: scan_client_dir(imagedir_app, subdir, cl_dir), client_dirs):
+        rows.extend(client_rows)
+  return rows
+
+def insert_files(session, rows, verbose):
+  """Inserts the given (client_id, path, session_id, darkened, shot_id) rows into the File table."""
+  for row in rows:
+    if verbose>1: print("  Adding file '%s'..." % (os.path.basename(row[1])))
+  if rows:
+    session.execute(File.__table__.insert(), [
+        {'client_id': r[0], 'path': r[1], 'session_id': r[2], 'darkened': r[3], 'shot_id': r[4]}
+        for r in rows])
+
+def add_files(session, imagedir, verbose, jobs=1):
+  """Add files to the XM2VTS database."""
 
-  def read_annotation(filename, file_id):
-    # read the eye positions, which are stored as four integers in one line
-    line = open(filename, 'r').readline()
-    positions = line.split()
-    assert len(positions) == 4
-    return Annotation(file_id, positions)
-
-  # iterate though all stored images and try to access the annotations
-  session.flush()
-  if verbose: print("Adding annotations from directory '%s' ..."%annotdir)
-  files = session.query(File)
-  for f in files:
-    if only_filename:
-      annot_file = os.path.join(annotdir, os.path.basename(f.path) + '.pos')
-    else:
-      annot_file = f.make_path(annotdir, '.pos')
-    if os.path.exists(annot_file):
-      if verbose>1: print("  Adding annotation '%s'..." %(annot_file, ))
-      session.add(read_annotation(annot_file, f.id))
+  insert_files(session, scan_files(imagedir, verbose, jobs), verbose)
+
+def read_annotation(filename):
+  """Reads the eye positions (re_x, re_y, le_x, le_y) of the given annotation
+  file, or returns None if the file does not exist."""
+  if not os.path.exists(filename):
+    return None
+  # the eye positions are stored as four integers in one line
+  with open(filename, 'r') as f:
+    positions = f.readline().split()
+  assert len(positions) == 4
+  return [int(p) for p in positions]
+
+def stat_annotation(filename):
+  """Returns the (mtime in nanoseconds, size) of the given annotation file, or
+  None if the file does not exist."""
+  try:
+    st = os.stat(filename)
+  except OSError:
+    return None
+  return (st.st_mtime_ns, st.st_size)
+
+def read_annotation_file(filename):
+  """Reads the given annotation file and returns the tuple (eyes, stat) of its
+  eye positions and of its :py:func:`stat_annotation`, or None if the file
+  does not exist."""
+  stat = stat_annotation(filename)
+  if stat is None:
+    return None
+  eyes = read_annotation(filename)
+  if eyes is None:
+    return None
+  return (eyes, stat)
+
+def annotation_candidates(files, annotdirs, only_filename = False):
+  """Returns the (file_id, annotation file) of all annotation files, which
+  might exist for the given (id, path) files in the given directories"""
+  candidates = []
+  for annotdir in annotdirs:
+    for file_id, path in files:
+      if only_filename:
+        candidates.append((file_id, os.path.join(annotdir, os.path.basename(path) + '.pos')))
+      else:
+        candidates.append((file_id, os.path.join(annotdir, path + '.pos')))
+  return candidates
+
+def read_annotations(files, annotdirs, verbose, only_filename = False, jobs = 1):
+  """Reads the annotation files of the given (id, path) files of the XM2VTS database.
+
+  The annotation files of all given directories are read in parallel using the
+  given number of threads.
+
+  Returns: the tuple (annotations, sources) of the rows of the Annotation and
+  of the AnnotationFile tables, in the order of the directories and files.
+  """
+
+  from concurrent.futures import ThreadPoolExecutor
+
+  # for all given images, try to access the annotations in all directories
+  if verbose:
+    for annotdir in annotdirs: print("Reading annotations from directory '%s' ..."%annotdir)
+  candidates = annotation_candidates(files, annotdirs, only_filename)
+
+  rows, sources = [], []
+  with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+    for (file_id, annot_file), result in zip(candidates, executor.map(read_annotation_file, [c[1] for c in candidates])):
+      if result is not None:
+        eyes, stat = result
+        if verbose>1: print("  Reading annotation '%s'..." %(annot_file, ))
+        rows.append({'file_id': file_id, 're_x': eyes[0], 're_y': eyes[1], 'le_x': eyes[2], 'le_y': eyes[3]})
+        sources.append({'path': annot_file, 'file_id': file_id, 'mtime': stat[0], 'size': stat[1]})
+  return rows, sources
+
+def insert_annotations(session, rows, sources):
+  """Inserts the given rows of the Annotation and AnnotationFile tables"""
+  if rows:
+    session.execute(Annotation.__table__.insert(), rows)
+  if sources:
+    session.execute(AnnotationFile.__table__.insert(), sources)
+
+def add_annotations(session, annotdirs, verbose, only_filename = False, jobs = 1):
+  """Reads annotation files of the XM2VTS database and stores the annotations in the sql database."""
 
+  files = session.query(File.id, File.path).order_by(File.id).all()
+  insert_annotations(session, *read_annotations(files, annotdirs, verbose, only_filename, jobs))
+
+
+# The (session_id, darkened, shot_id) of the files of the XM2VTS protocols
+ALL_NORMAL = [(1, 'n', 1), (1, 'n', 2), (2, 'n', 1), (2, 'n', 2), (3, 'n', 1), (3, 'n', 2), (4, 'n', 1), (4, 'n', 2)]
+ALL_DARKENED = [(4, 'l', 1), (4, 'l', 2), (4, 'r', 1), (4, 'r', 2)]
+
+# The (group, purpose) of the protocol purposes, in the order they are created
+PROTOCOL_PURPOSES = [('world', 'train'), ('dev', 'enroll'), ('dev', 'probe'), ('eval', 'enroll'), ('eval', 'probe')]
+
+def _protocol(enroll, dev_probe_c, dev_probe_i, eval_probe_c, eval_probe_i):
+  """Returns the files of each (group, purpose) of a protocol, as a tuple
+  (client files, impostor files)"""
+  return {
+    ('world', 'train'): (enroll, []),
+    ('dev', 'enroll'): (enroll, []),
+    ('dev', 'probe'): (dev_probe_c, dev_probe_i),
+    ('eval', 'enroll'): (enroll, []),
+    ('eval', 'probe'): (eval_probe_c, eval_probe_i),
+  }
+
+# The definitions of the protocols, in the order they are created
+PROTOCOLS = [
+  ('lp1', _protocol(
+    enroll = [(1, 'n', 1), (2, 'n', 1), (3, 'n', 1)],
+    dev_probe_c = [(1, 'n', 2), (2, 'n', 2), (3, 'n', 2)],
+    dev_probe_i = ALL_NORMAL,
+    eval_probe_c = [(4, 'n', 1), (4, 'n', 2)],
+    eval_probe_i = ALL_NORMAL)),
+  ('lp2', _protocol(
+    enroll = [(1, 'n', 1), (1, 'n', 2), (2, 'n', 1), (2, 'n', 2)],
+    dev_probe_c = [(3, 'n', 1), (3, 'n', 2)],
+    dev_probe_i = ALL_NORMAL,
+    eval_probe_c = [(4, 'n', 1), (4, 'n', 2)],
+    eval_probe_i = ALL_NORMAL)),
+  ('darkened-lp1', _protocol(
+    enroll = [(1, 'n', 1), (2, 'n', 1), (3, 'n', 1)],
+    dev_probe_c = [(1, 'n', 2), (2, 'n', 2), (3, 'n', 2)],
+    dev_probe_i = ALL_NORMAL,
+    eval_probe_c = ALL_DARKENED,
+    eval_probe_i = ALL_DARKENED)),
+  ('darkened-lp2', _protocol(
+    enroll = [(1, 'n', 1), (1, 'n', 2), (2, 'n', 1), (2, 'n', 2)],
+    dev_probe_c = [(3, 'n', 1), (3, 'n', 2)],
+    dev_probe_i = ALL_NORMAL,
+    eval_probe_c = ALL_DARKENED,
+    eval_probe_i = ALL_DARKENED)),
+]
+
+def protocol_memberships(purposes, files):
+  """Computes the protocol purposes of the given files in a single pass.
+
+  Keyword Parameters:
+
+  purposes
+    A list of (id, protocol name, group, purpose) of the protocol purposes.
+
+  files
+    An iterable of (id, session_id, darkened, shot_id, client group) of the files.
+
+  Returns: A sorted list of (protocol purpose id, file id) pairs.
+  """
+
+  rules = []
+  protocols = dict(PROTOCOLS)
+  for pu_id, protocol, group, purpose in purposes:
+    clients, impostors = protocols[protocol][(group, purpose)]
+    rules.append((pu_id, set(clients), COHORT_GROUPS.get(group), set(impostors)))
+
+  pairs = []
+  for file_id, session_id, darkened, shot_id, client_group in files:
+    key = (session_id, darkened, shot_id)
+    for pu_id, clients, impostor_group, impostors in rules:
+      if (client_group == 'client' and key in clients) or \
+         (client_group == impostor_group and key in impostors):
+        pairs.append((pu_id, file_id))
+  return sorted(pairs)
 
 def add_protocols(session, verbose):
   """Adds protocols"""
 
-  # 1. DEFINITIONS
-  protocol_definitions = {}
-  all_normal = [(1, 'n', 1), (1, 'n', 2), (2, 'n', 1), (2, 'n', 2), (3, 'n', 1), (3, 'n', 2), (4, 'n', 1), (4, 'n', 2)]
-  all_darkened = [(4, 'l', 1), (4, 'l', 2), (4, 'r', 1), (4, 'r', 2)]
-  # Protocol lp1
-  enroll = [(1, 'n', 1), (2, 'n', 1), (3, 'n', 1)]
-  dev_probe_c = [(1, 'n', 2), (2, 'n', 2), (3, 'n', 2)]
-  dev_probe_i = all_normal
-  eval_probe_c = [(4, 'n', 1), (4, 'n', 2)]
-  eval_probe_i = all_normal
-  protocol_definitions['lp1'] = [enroll, dev_probe_c, dev_probe_i, eval_probe_c, eval_probe_i]
-
-  # Protocol lp2
-  enroll = [(1, 'n', 1), (1, 'n', 2), (2, 'n', 1), (2, 'n', 2)]
-  dev_probe_c = [(3, 'n', 1), (3, 'n', 2)]
-  dev_probe_i = all_normal
-  eval_probe_c = [(4, 'n', 1), (4, 'n', 2)]
-  eval_probe_i = all_normal
-  protocol_definitions['lp2'] = [enroll, dev_probe_c, dev_probe_i, eval_probe_c, eval_probe_i]
-
-   # Protocol darkened-lp1
-  enroll = [(1, 'n', 1), (2, 'n', 1), (3, 'n', 1)]
-  dev_probe_c = [(1, 'n', 2), (2, 'n', 2), (3, 'n', 2)]
-  dev_probe_i = all_normal
-  eval_probe_c = [(4, 'l', 1), (4, 'l', 2), (4, 'r', 1), (4, 'r', 2)]
-  eval_probe_i = all_darkened
-  protocol_definitions['darkened-lp1'] = [enroll, dev_probe_c, dev_probe_i, eval_probe_c, eval_probe_i]
-
-   # Protocol darkened-lp2
-  enroll = [(1, 'n', 1), (1, 'n', 2), (2, 'n', 1), (2, 'n', 2)]
-  dev_probe_c = [(3, 'n', 1), (3, 'n', 2)]
-  dev_probe_i = all_normal
-  eval_probe_c = [(4, 'l', 1), (4, 'l', 2), (4, 'r', 1), (4, 'r', 2)]
-  eval_probe_i = all_darkened
-  protocol_definitions['darkened-lp2'] = [enroll, dev_probe_c, dev_probe_i, eval_probe_c, eval_probe_i]
-
-  # 2. ADDITIONS TO THE SQL DATABASE
-  protocolPurpose_list = [('world', 'train'), ('dev', 'enroll'), ('dev', 'probe'), ('eval', 'enroll'), ('eval', 'probe')]
-  for proto in protocol_definitions:
-    p = Protocol(proto)
-    # Add protocol
+  # since the tables are empty, the ids of the protocols and of their purposes
+  # are set explicitly
+  protocol_rows = []
+  purpose_rows = []
+  purposes = []
+  for proto, definition in PROTOCOLS:
+    p_id = len(protocol_rows) + 1
     if verbose: print("Adding protocol %s..." % (proto))
-    session.add(p)
-    session.flush()
-    session.refresh(p)
-
-    # Add protocol purposes
-    for key in range(len(protocolPurpose_list)):
-      purpose = protocolPurpose_list[key]
-      pu = ProtocolPurpose(p.id, purpose[0], purpose[1])
-      if verbose>1: print("  Adding protocol purpose ('%s','%s')..." % (purpose[0], purpose[1]))
-      session.add(pu)
-      session.flush()
-      session.refresh(pu)
-
-      # Add files attached with this protocol purpose
-      list_properties = []
-      list_properties_i = []
-      impostor_val = ''
-      if(key == 0 or key == 1 or key == 3): # world/enroll data
-        list_properties = protocol_definitions[proto][0]
-      elif(key == 2):
-        list_properties = protocol_definitions[proto][1]
-        list_properties_i = protocol_definitions[proto][2]
-        impostor_val = 'impostorDev'
-      elif(key == 4):
-        list_properties = protocol_definitions[proto][3]
-        list_properties_i = protocol_definitions[proto][4]
-        impostor_val = 'impostorEval'
-
-      # Loops over the properties list which defines the protocol
-      for el in list_properties:
-        q = session.query(File).join(Client).\
-              filter(Client.sgroup == 'client').\
-              filter(and_(File.session_id == el[0], File.darkened == el[1], File.shot_id == el[2])).\
-              order_by(File.id)
-        for k in q:
-          if verbose>1: print("    Adding protocol file '%s'..." % (k.path))
-          pu.files.append(k)
-
-      # Adds impostors if required
-      if(key == 2 or key == 4):
-        for el in list_properties_i:
-          q = session.query(File).join(Client).\
-                filter(Client.sgroup == impostor_val).\
-                filter(and_(File.session_id == el[0], File.darkened == el[1], File.shot_id == el[2])).\
-                order_by(File.id)
-          for k in q:
-            if verbose>1: print("    Adding protocol file (impostor) '%s'..." % (k.path))
-            pu.files.append(k)
+    protocol_rows.append({'id': p_id, 'name': proto})
+    for group, purpose in PROTOCOL_PURPOSES:
+      pu_id = len(purpose_rows) + 1
+      if verbose>1: print("  Adding protocol purpose ('%s','%s')..." % (group, purpose))
+      purpose_rows.append({'id': pu_id, 'protocol_id': p_id, 'sgroup': group, 'purpose': purpose})
+      purposes.append((pu_id, proto, group, purpose))
+
+  # the files of all protocol purposes are computed in a single pass over the files
+  files = session.query(File.id, File.session_id, File.darkened, File.shot_id, Client.sgroup).\
+      filter(File.client_id == Client.id)
+  association_rows = [{'protocolPurpose_id': pu_id, 'file_id': file_id}
+                      for pu_id, file_id in protocol_memberships(purposes, files)]
+  if verbose>1: print("  Adding %d protocol files..." % len(association_rows))
+
+  session.execute(Protocol.__table__.insert(), protocol_rows)
+  session.execute(ProtocolPurpose.__table__.insert(), purpose_rows)
+  if association_rows:
+    session.execute(protocolPurpose_file_association.insert(), association_rows)
+
+def write_snapshot(session, filename, verbose):
+  """Writes the content of the database to a snapshot file, which is read by
+  :py:class:`bob.db.xm2vts.snapshot.SnapshotDatabase`"""
+
+  from .snapshot import save
+  if verbose: print("Writing snapshot '%s'..." % filename)
+
+  def rows(q):
+    return [list(r) for r in q]
+
+  data = {
+    'client_groups': list(Client.group_choices),
+    'groups': list(ProtocolPurpose.group_choices),
+    'purposes': list(ProtocolPurpose.purpose_choices),
+    'clients': rows(session.query(Client.id, Client.sgroup).order_by(Client.id)),
+    'files': rows(session.query(File.id, File.client_id, File.path, File.session_id, File.darkened, File.shot_id).order_by(File.id)),
+    'protocols': rows(session.query(Protocol.id, Protocol.name).order_by(Protocol.id)),
+    'protocol_purposes': rows(session.query(ProtocolPurpose.id, ProtocolPurpose.protocol_id, ProtocolPurpose.sgroup, ProtocolPurpose.purpose).order_by(ProtocolPurpose.id)),
+    'memberships': rows(session.query(protocolPurpose_file_association.c.protocolPurpose_id, protocolPurpose_file_association.c.file_id)),
+    'annotations': rows(session.query(Annotation.file_id, Annotation.re_y, Annotation.re_x, Annotation.le_y, Annotation.le_x).order_by(Annotation.id)),
+  }
+  save(data, filename)
+
+def snapshot_file(dbfile):
+  """Returns the name of the snapshot file, which belongs to the given database file"""
+  return os.path.join(os.path.dirname(dbfile), 'db.snapshot')
+
+def trials_file(dbfile, protocol, group):
+  """Returns the name of the file, in which :py:meth:`bob.db.xm2vts.Database.trial_list`
+  caches the trials of the given protocol and group of the given database file"""
+  return os.path.join(os.path.dirname(dbfile), 'trials-%s-%s.npz' % (protocol, group))
+
+def remove_trials(dbfile, verbose):
+  """Removes the cached trials of the given database file, which are outdated
+  once the database is modified"""
+  import glob
+  for filename in glob.glob(trials_file(dbfile, '*', '*')):
+    if verbose: print("Removing outdated trials '%s'..." % filename)
+    os.unlink(filename)
 
 def create_tables(args):
   """Creates all necessary tables (only to be used at the first time)"""
@@ -225,6 +364,20 @@ def create_tables(args):
 # Driver API
 # ==========
 
+def annotation_directories(args):
+  """Returns the list of annotation directories given on the command line, and
+  whether the annotation files are only identified by the file names."""
+  if args.annotsub:
+    return [os.path.join(args.annotdir, subdir) for subdir in args.annotsub], True
+  return [args.annotdir], False
+
+def delete_rows(session, table, column, ids):
+  """Deletes the rows of the given table, whose column has one of the given values."""
+  ids = list(ids)
+  # limit the number of SQL variables per statement
+  for i in range(0, len(ids), 500):
+    session.execute(table.delete().where(column.in_(ids[i:i + 500])))
+
 def create(args):
   """Creates or re-creates this database"""
 
@@ -243,26 +396,136 @@ def create(args):
   # the real work...
   create_tables(args)
   s = session_try_nolock(args.type, dbfile, echo=(args.verbose > 2))
+  # all tables are filled in a single transaction, which is not synced to disk
+  # before the end, since a failed creation is simply repeated
+  if args.type == 'sqlite':
+    s.execute(text('PRAGMA synchronous = OFF'))
+    s.execute(text('PRAGMA journal_mode = MEMORY'))
   add_clients(s, args.verbose)
-  add_files(s, args.imagedir, args.verbose)
+  add_files(s, args.imagedir, args.verbose, args.jobs)
   add_protocols(s, args.verbose)
-  if args.annotsub:
-    for subdir in args.annotsub:
-      add_annotations(s, os.path.join(args.annotdir, subdir), args.verbose, True)
-  else:
-    add_annotations(s, args.annotdir, args.verbose)
+  annotdirs, only_filename = annotation_directories(args)
+  add_annotations(s, annotdirs, args.verbose, only_filename, args.jobs)
+  s.commit()
+  write_snapshot(s, snapshot_file(dbfile), args.verbose)
+  remove_trials(dbfile, args.verbose)
+  s.close()
+
+def add_indexes(session, verbose):
+  """Creates the indexes of the tables, which are missing in databases created
+  by earlier versions of this package."""
+
+  from sqlalchemy import inspect
+  connection = session.connection()
+  inspector = inspect(connection)
+  for table in Base.metadata.sorted_tables:
+    existing = set(index['name'] for index in inspector.get_indexes(table.name))
+    for index in table.indexes:
+      if index.name not in existing:
+        if verbose: print("Adding index '%s'..." % index.name)
+        index.create(connection)
+
+def update(args):
+  """Updates this database incrementally from the image and annotation directories"""
+
+  from bob.db.base.utils import session_try_nolock
+
+  dbfile = args.files[0]
+  if not os.path.exists(dbfile):
+    raise IOError("The database '%s' does not exist; please use the 'create' command instead" % dbfile)
+
+  s = session_try_nolock(args.type, dbfile, echo=(args.verbose > 2))
+
+  # 0. SCHEMA: databases of earlier versions miss some tables and indexes
+  Base.metadata.create_all(s.connection())
+  add_indexes(s, args.verbose)
+  if args.schema_only:
+    s.commit()
+    s.close()
+    return
+
+  # 1. FILES: the registered files are compared to the images by path, since
+  # all attributes of a File are derived from its path
+  stored = dict((path, file_id) for file_id, path in s.query(File.id, File.path))
+  scanned = scan_files(args.imagedir, args.verbose, args.jobs)
+  scanned_paths = set(r[1] for r in scanned)
+  removed = [file_id for path, file_id in stored.items() if path not in scanned_paths]
+  added = [r for r in scanned if r[1] not in stored]
+  if args.verbose: print("Removing %d and adding %d files..." % (len(removed), len(added)))
+
+  delete_rows(s, protocolPurpose_file_association, protocolPurpose_file_association.c.file_id, removed)
+  delete_rows(s, Annotation.__table__, Annotation.__table__.c.file_id, removed)
+  delete_rows(s, AnnotationFile.__table__, AnnotationFile.__table__.c.file_id, removed)
+  delete_rows(s, File.__table__, File.__table__.c.id, removed)
+  insert_files(s, added, args.verbose)
+
+  # adds the new files to the protocols
+  added_paths = [r[1] for r in added]
+  files = []
+  for i in range(0, len(added_paths), 500):
+    files += s.query(File.id, File.session_id, File.darkened, File.shot_id, Client.sgroup).\
+        filter(File.client_id == Client.id).\
+        filter(File.path.in_(added_paths[i:i + 500])).all()
+  purposes = s.query(ProtocolPurpose.id, Protocol.name, ProtocolPurpose.sgroup, ProtocolPurpose.purpose).\
+      filter(ProtocolPurpose.protocol_id == Protocol.id).all()
+  association_rows = [{'protocolPurpose_id': pu_id, 'file_id': file_id}
+                      for pu_id, file_id in protocol_memberships(purposes, files)]
+  if association_rows:
+    s.execute(protocolPurpose_file_association.insert(), association_rows)
+
+  # 2. ANNOTATIONS: the modification time and size of the annotation files
+  # are compared to the ones of the files read before, and the annotations of
+  # all images with a new, modified or deleted annotation file are read again
+  from concurrent.futures import ThreadPoolExecutor
+  annotdirs, only_filename = annotation_directories(args)
+  files = s.query(File.id, File.path).order_by(File.id).all()
+  candidates = annotation_candidates(files, annotdirs, only_filename)
+  stored = dict((path, (file_id, mtime, size)) for path, file_id, mtime, size in
+      s.query(AnnotationFile.path, AnnotationFile.file_id, AnnotationFile.mtime, AnnotationFile.size))
+  with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+    stats = list(executor.map(stat_annotation, [c[1] for c in candidates]))
+  changed = set()
+  for (file_id, path), stat in zip(candidates, stats):
+    old = stored.pop(path, None)
+    if (old is None and stat is not None) or (old is not None and (file_id,) + tuple(stat or ()) != old):
+      changed.add(file_id)
+  # the annotation files of other images or directories
+  changed.update(old[0] for old in stored.values())
+  if args.verbose: print("Updating the annotations of %d files..." % len(changed))
+
+  changed = sorted(changed)
+  delete_rows(s, Annotation.__table__, Annotation.__table__.c.file_id, changed)
+  delete_rows(s, AnnotationFile.__table__, AnnotationFile.__table__.c.file_id, changed)
+  delete_rows(s, AnnotationFile.__table__, AnnotationFile.__table__.c.path, list(stored))
+  changed = set(changed)
+  insert_annotations(s, *read_annotations([f for f in files if f[0] in changed], annotdirs, args.verbose, only_filename, args.jobs))
+
   s.commit()
+  write_snapshot(s, snapshot_file(dbfile), args.verbose)
+  remove_trials(dbfile, args.verbose)
   s.close()
 
+def add_tree_arguments(parser):
+  """Adds the options, which define the location of the images and annotations, to the given parser"""
+
+  parser.add_argument('-v', '--verbose', action='count', default=0, help="Do SQL operations in a verbose way?")
+  parser.add_argument('-D', '--imagedir', metavar='DIR', default='/idiap/resource/database/xm2vtsdb/images/', help="Change the relative path to the directory containing the images of the XM2VTS database.")
+  parser.add_argument('-A', '--annotdir', metavar='DIR', default='/idiap/group/biometric/annotations/xm2vts/', help="Change the relative path to the directory containing the annotations of the XM2VTS database (defaults to %(default)s)")
+  parser.add_argument('-j', '--jobs', type=int, default=1, help="The number of threads used to scan the image directories and to read the annotation files (defaults to %(default)s)")
+  parser.add_argument('-S', '--annotsub', metavar='DIR', nargs='+', help="Sub-directories of the XM2VTS annotation directory to consider, which will replace the stem path of the registered Files")
+
 def add_command(subparsers):
   """Add specific subcommands that the action "create" can use"""
 
   parser = subparsers.add_parser('create', help=create.__doc__)
 
   parser.add_argument('-R', '--recreate', action='store_true', help="If set, I'll first erase the current database")
-  parser.add_argument('-v', '--verbose', action='count', help="Do SQL operations in a verbose way?")
-  parser.add_argument('-D', '--imagedir', metavar='DIR', default='/idiap/resource/database/xm2vtsdb/images/', help="Change the relative path to the directory containing the images of the XM2VTS database.")
-  parser.add_argument('-A', '--annotdir', metavar='DIR', default='/idiap/group/biometric/annotations/xm2vts/', help="Change the relative path to the directory containing the annotations of the XM2VTS database (defaults to %(default)s)")
-  parser.add_argument('-S', '--annotsub', metavar='DIR', nargs='+', help="Sub-directories of the XM2VTS annotation directory to consider, which will replace the stem path of the registered Files")
+  add_tree_arguments(parser)
 
   parser.set_defaults(func=create) #action
+
+  parser = subparsers.add_parser('update', help=update.__doc__)
+  parser.add_argument('--schema-only', action='store_true', help="If set, I'll only add the indexes missing in databases created by earlier versions, without looking at the image and annotation directories")
+  add_tree_arguments(parser)
+
+  parser.set_defaults(func=update) #action
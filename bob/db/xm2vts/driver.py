@@ -23,18 +23,66 @@ import os
 import sys
 from bob.db.base.driver import Interface as BaseInterface
 
+def _check_choice(option, value, choices):
+  """Checks a command-line option whose valid choices are read from the
+  database, which is only done when the command is run. Prints an error
+  message in the style of argparse and returns False if the value is invalid."""
+
+  if value is None or value in choices:
+    return True
+  sys.stderr.write("error: argument %s: invalid choice: %r (choose from %s)\n" % \
+      (option, value, ', '.join(repr(c) for c in choices)))
+  return False
+
+def _write_chunked(output, entries, separator, chunk_size=1000):
+  """Writes the given entries, each followed by the separator, in chunks of
+  ``chunk_size`` entries, which are flushed as soon as they are written, so
+  that the consumer of a pipe can start before the last entry is read."""
+
+  chunk = []
+  for entry in entries:
+    chunk.append(entry)
+    if len(chunk) == chunk_size:
+      output.write(separator.join(chunk) + separator)
+      if hasattr(output, 'flush'): output.flush()
+      chunk = []
+  if chunk:
+    output.write(separator.join(chunk) + separator)
+    if hasattr(output, 'flush'): output.flush()
+
+def _shard(value):
+  """Type of the ``--shard k/n`` option of the command line"""
+
+  import argparse
+  try:
+    k, n = (int(v) for v in value.split('/'))
+  except ValueError:
+    raise argparse.ArgumentTypeError("invalid shard %r, expected k/n" % (value,))
+  if not 0 <= k < n:
+    raise argparse.ArgumentTypeError("invalid shard %r, expected k/n with 0 <= k < n" % (value,))
+  return k, n
+
 def dumplist(args):
   """Dumps lists of files based on your criteria"""
 
   from .query import Database
-  db = Database()
+  db = Database(lightweight=True)
 
-  r = db.objects(
+  # the choices of these options are only known once the database is opened
+  if not (_check_choice('-p/--protocol', args.protocol, db.protocol_names()) and
+          _check_choice('-u/--purpose', args.purpose, db.purposes()) and
+          _check_choice('-g/--group', args.group, db.groups()) and
+          _check_choice('-C/--client', args.client, db.model_ids())):
+    return 2
+
+  r = db.iter_objects(
       protocol=args.protocol,
       purposes=args.purpose,
-      model_ids=(args.client,),
+      model_ids=(args.client,) if args.client is not None else None,
       groups=args.group,
-      classes=args.sclass
+      classes=args.sclass,
+      shard=args.shard,
+      shard_by=args.shard_by
   )
 
   output = sys.stdout
@@ -42,27 +90,51 @@ def dumplist(args):
     from bob.db.base.utils import null
     output = null()
 
-  for f in r:
-    output.write('%s\n' % (f.make_path(args.directory, args.extension),))
+  if args.format == 'jsonl':
+    import json
+    entries = (json.dumps({'id': f.id, 'path': f.make_path(args.directory, args.extension), 'client_id': f.client_id}) for f in r)
+  else:
+    entries = (f.make_path(args.directory, args.extension) for f in r)
+
+  _write_chunked(output, entries, '\0' if args.format == 'nul' else '\n')
 
   return 0
 
+def _check_directory(directory, names, verify):
+  """Checks the given file names inside a single directory, which is listed
+  only once. If ``verify`` is set, the files must also be readable and not
+  empty. Returns the names of the missing (or invalid) files."""
+
+  try:
+    entries = dict((e.name, e) for e in os.scandir(directory or '.'))
+  except OSError:
+    return list(names)
+
+  bad = []
+  for name in names:
+    entry = entries.get(name)
+    if entry is None or not entry.is_file():
+      bad.append(name)
+    elif verify and (entry.stat().st_size == 0 or not os.access(entry.path, os.R_OK)):
+      bad.append(name)
+  return bad
+
 def checkfiles(args):
   """Checks existence of files based on your criteria"""
 
+  import time
+  from concurrent.futures import ThreadPoolExecutor
   from .query import Database
-  db = Database()
+  db = Database(lightweight=True)
 
+  start = time.time()
   r = db.objects()
 
-  # go through all files, check if they are available on the filesystem
-  good = []
-  bad = []
+  # groups the files by directory, so that each directory is listed only once
+  directories = {}
   for f in r:
-    if os.path.exists(f.make_path(args.directory, args.extension)):
-      good.append(f)
-    else:
-      bad.append(f)
+    path = f.make_path(args.directory, args.extension)
+    directories.setdefault(os.path.dirname(path), []).append(os.path.basename(path))
 
   # report
   output = sys.stdout
@@ -70,14 +142,51 @@ def checkfiles(args):
     from bob.db.base.utils import null
     output = null()
 
+  # go through all directories in parallel, check if the files are available
+  # on the filesystem
+  bad = []
+  checked = 0
+  with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+    results = executor.map(lambda d: _check_directory(d[0], d[1], args.verify), directories.items())
+    for (directory, names), missing in zip(directories.items(), results):
+      bad.extend(os.path.join(directory, name) for name in missing)
+      checked += len(names)
+      if args.verbose:
+        sys.stderr.write('Checked %d of %d files...\r' % (checked, len(r)))
+  if args.verbose:
+    sys.stderr.write('\n')
+  elapsed = time.time() - start
+
   if bad:
-    for f in bad:
-      output.write('Cannot find file "%s"\n' % (f.make_path(args.directory, args.extension),))
+    for path in sorted(bad):
+      output.write('Cannot find file "%s"\n' % (path,))
     output.write('%d files (out of %d) were not found at "%s"\n' % \
       (len(bad), len(r), args.directory))
 
+  output.write('Checked %d files in %.2f s (%.1f files/s)\n' % \
+      (len(r), elapsed, len(r) / elapsed if elapsed > 0 else float('inf')))
+
   return 0
 
+def _read_stdin(option, values):
+  """Returns the given command-line values, or the whitespace-separated values
+  read from the standard input if the only value is ``-``. Prints an error
+  message in the style of argparse and returns None if ``-`` is given together
+  with other values."""
+
+  values = list(values)
+  if values == ['-']:
+    return sys.stdin.read().split()
+  if '-' in values:
+    sys.stderr.write("error: argument %s: '-' must be the only value\n" % (option,))
+    return None
+  return values
+
+def _file_id(value):
+  """Type of the file ids on the command line, which may also be ``-``"""
+
+  return value if value == '-' else int(value)
+
 def reverse(args):
   """Returns a list of file database identifiers given the path stems"""
 
@@ -89,10 +198,15 @@ def reverse(args):
     from bob.db.base.utils import null
     output = null()
 
-  r = db.reverse(args.path)
-  for f in r: output.write('%d\n' % f.id)
+  paths = _read_stdin('path', args.path)
+  if paths is None:
+    return 2
 
-  if not r: return 1
+  ids = db.reverse_bulk(paths)
+  ids = ids[ids >= 0]
+  _write_chunked(output, ('%d' % i for i in ids), '\n')
+
+  if not len(ids): return 1
 
   return 0
 
@@ -107,10 +221,29 @@ def path(args):
     from bob.db.base.utils import null
     output = null()
 
-  r = db.paths(args.id, prefix=args.directory, suffix=args.extension)
-  for path in r: output.write('%s\n' % path)
+  ids = _read_stdin('id', args.id)
+  if ids is None:
+    return 2
+
+  paths = db.paths_bulk([int(i) for i in ids], prefix=args.directory, suffix=args.extension)
+  paths = [p for p in paths if p is not None]
+  _write_chunked(output, paths, '\n')
 
-  if not r: return 1
+  if not paths: return 1
+
+  return 0
+
+
+def snapshot(args):
+  """Writes the snapshot of the database, which is served without SQLAlchemy"""
+
+  from bob.db.base.utils import session_try_readonly
+  from .create import write_snapshot, snapshot_file
+
+  dbfile = Interface().files()[0]
+  s = session_try_readonly(Interface().type(), dbfile)
+  write_snapshot(s, args.output or snapshot_file(dbfile), args.verbose)
+  s.close()
 
   return 0
 
@@ -127,7 +260,7 @@ class Interface(BaseInterface):
   def files(self):
 
     from pkg_resources import resource_filename
-    raw_files = ('db.sql3',)
+    raw_files = ('db.sql3', 'db.snapshot')
     return [resource_filename(__name__, k) for k in raw_files]
 
   def type(self):
@@ -144,19 +277,20 @@ class Interface(BaseInterface):
     from .create import add_command as create_command
     create_command(subparsers)
 
-    from .query import Database
     import argparse
-    db = Database()
 
     # example: get the "dumplist" action from a submodule
     parser = subparsers.add_parser('dumplist', help=dumplist.__doc__)
     parser.add_argument('-d', '--directory', default='', help="if given, this path will be prepended to every entry returned.")
     parser.add_argument('-e', '--extension', default='', help="if given, this extension will be appended to every entry returned.")
-    parser.add_argument('-p', '--protocol', help="if given, limits the dump to a particular subset of the data that corresponds to the given protocol.", choices=db.protocol_names() if db.is_valid() else ())
-    parser.add_argument('-u', '--purpose', help="if given, this value will limit the output files to those designed for the given purposes.", choices=db.purposes() if db.is_valid() else ())
-    parser.add_argument('-C', '--client', type=int, help="if given, this value will limit the output files to those belonging to a particular protocolar group.", choices=db.model_ids() if db.is_valid() else ())
-    parser.add_argument('-g', '--group', help="if given, this value will limit the output files to those belonging to a particular protocolar group.", choices=db.groups() if db.is_valid() else ())
+    parser.add_argument('-p', '--protocol', help="if given, limits the dump to a particular subset of the data that corresponds to the given protocol.")
+    parser.add_argument('-u', '--purpose', help="if given, this value will limit the output files to those designed for the given purposes.")
+    parser.add_argument('-C', '--client', type=int, help="if given, this value will limit the output files to those belonging to a particular protocolar group.")
+    parser.add_argument('-g', '--group', help="if given, this value will limit the output files to those belonging to a particular protocolar group.")
     parser.add_argument('-c', '--class', dest="sclass", help="if given, this value will limit the output files to those belonging to the given classes.", choices=('client', 'impostor', ''))
+    parser.add_argument('-s', '--shard', type=_shard, help="if given as k/n (with 0 <= k < n), only dumps the k-th of n disjoint parts of the list, e.g., for the k-th of n parallel jobs.")
+    parser.add_argument('--shard-by', default='file', choices=('file', 'client'), help="how the files are distributed over the shards: by file or by client, which keeps all files of a client in the same shard.")
+    parser.add_argument('-f', '--format', default='newline', choices=('newline', 'nul', 'jsonl'), help="the output format: one path per line (the default), NUL-separated paths (e.g. for 'xargs -0') or one JSON object with the id, path and client_id of each file per line.")
     parser.add_argument('--self-test', dest="selftest", action='store_true', help=argparse.SUPPRESS)
     parser.set_defaults(func=dumplist) #action
 
@@ -164,12 +298,15 @@ class Interface(BaseInterface):
     parser = subparsers.add_parser('checkfiles', help=checkfiles.__doc__)
     parser.add_argument('-d', '--directory', default='', help="if given, this path will be prepended to every entry returned.")
     parser.add_argument('-e', '--extension', default='', help="if given, this extension will be appended to every entry returned.")
+    parser.add_argument('-j', '--jobs', type=int, default=1, help="the number of directories which are checked in parallel, which speeds up the check on network file systems.")
+    parser.add_argument('-V', '--verify', action='store_true', help="if given, the files must also be readable and not empty.")
+    parser.add_argument('-v', '--verbose', action='count', default=0, help="Prints the progress of the check")
     parser.add_argument('--self-test', dest="selftest", action='store_true', help=argparse.SUPPRESS)
     parser.set_defaults(func=checkfiles) #action
 
     # adds the "reverse" command
     parser = subparsers.add_parser('reverse', help=reverse.__doc__)
-    parser.add_argument('path', nargs='+', type=str, help="one or more path stems to look up. If you provide more than one, files which cannot be reversed will be omitted from the output.")
+    parser.add_argument('path', nargs='+', type=str, help="one or more path stems to look up, or '-' to read them from the standard input. If you provide more than one, files which cannot be reversed will be omitted from the output.")
     parser.add_argument('--self-test', dest="selftest", action='store_true', help=argparse.SUPPRESS)
     parser.set_defaults(func=reverse) #action
 
@@ -177,7 +314,13 @@ class Interface(BaseInterface):
     parser = subparsers.add_parser('path', help=path.__doc__)
     parser.add_argument('-d', '--directory', default='', help="if given, this path will be prepended to every entry returned.")
     parser.add_argument('-e', '--extension', default='', help="if given, this extension will be appended to every entry returned.")
-    parser.add_argument('id', nargs='+', type=int, help="one or more file ids to look up. If you provide more than one, files which cannot be found will be omitted from the output. If you provide a single id to lookup, an error message will be printed if the id does not exist in the database. The exit status will be non-zero in such case.")
+    parser.add_argument('id', nargs='+', type=_file_id, help="one or more file ids to look up, or '-' to read them from the standard input. If you provide more than one, files which cannot be found will be omitted from the output. If you provide a single id to lookup, an error message will be printed if the id does not exist in the database. The exit status will be non-zero in such case.")
     parser.add_argument('--self-test', dest="selftest", action='store_true', help=argparse.SUPPRESS)
     parser.set_defaults(func=path) #action
 
+    # adds the "snapshot" command
+    parser = subparsers.add_parser('snapshot', help=snapshot.__doc__)
+    parser.add_argument('-o', '--output', help="if given, the snapshot is written to this file instead of the default location next to the SQL database.")
+    parser.add_argument('-v', '--verbose', action='count', default=0, help="Increases the verbosity of the output")
+    parser.set_defaults(func=snapshot) #action
+
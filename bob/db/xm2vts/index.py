@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# Copyright (C) 2011-2013 Idiap Research Institute, Martigny, Switzerland
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""In-memory index of the XM2VTS protocols, which allows to answer the queries
+of :py:meth:`bob.db.xm2vts.Database.objects` without any SQL round trip, and
+the definitions shared by :py:class:`bob.db.xm2vts.Database` and
+:py:class:`bob.db.xm2vts.SnapshotDatabase`.
+"""
+
+# the client group, from which the impostors of each group of the protocols are
+# taken. They are also the cohort for the score normalization of the models of
+# the same group, so that no data of the evaluation set is used to tune the
+# development set (and vice versa)
+COHORT_GROUPS = {'dev': 'impostorDev', 'eval': 'impostorEval'}
+
+# the fields of the trials returned by trial_list()
+TRIAL_FIELDS = [('model_index', 'int32'), ('probe_index', 'int32'), ('is_genuine', 'bool')]
+
+
+def check_shard(shard, shard_by):
+  """Validates the shard parameters of :py:meth:`bob.db.xm2vts.Database.objects`
+  and returns the shard as a tuple ``(k, n)``, or ``None`` if no shard is
+  selected"""
+
+  if shard_by not in ('file', 'client'):
+    raise ValueError("Invalid shard_by '%s'. Valid values are 'file' or 'client'" % (shard_by,))
+  if shard is None:
+    return None
+  k, n = (int(v) for v in shard)
+  if not 0 <= k < n:
+    raise ValueError("Invalid shard %s. Valid values are (k, n) with 0 <= k < n" % (tuple(shard),))
+  return k, n
+
+
+def shard_clients(clients, shard, purposes, groups, classes):
+  """Returns the set of ids of the clients of the given checked shard of a
+  query of :py:meth:`bob.db.xm2vts.Database.objects` with the given checked
+  ``purposes``, ``groups`` and ``classes``. Only the clients of the client
+  groups which the query can return, ordered by id, are dealt round-robin
+  over the shards. ``clients`` is an iterable of the clients of the
+  database."""
+
+  sgroups = set()
+  if 'world' in groups:
+    sgroups.add('client')
+  for group in ('dev', 'eval'):
+    if group in groups:
+      if 'enroll' in purposes or ('probe' in purposes and 'client' in classes):
+        sgroups.add('client')
+      if 'probe' in purposes and 'impostor' in classes:
+        sgroups.add(COHORT_GROUPS[group])
+  k, n = shard
+  selectable = sorted(c.id for c in clients if c.sgroup in sgroups)
+  return set(selectable[k::n])
+
+
+def make_trials(model_ids, probe_ids, mask):
+  """Returns the ``(model_ids, probe_ids, trials)`` of
+  :py:meth:`bob.db.xm2vts.Database.trial_list` for the given model ids, probe
+  file ids and the mask of :py:meth:`bob.db.xm2vts.Database.probe_matrix`"""
+
+  import numpy
+  model_index, probe_index = numpy.indices(mask.shape, dtype=numpy.int32)
+  trials = numpy.empty(mask.size, dtype=TRIAL_FIELDS)
+  trials['model_index'] = model_index.ravel()
+  trials['probe_index'] = probe_index.ravel()
+  trials['is_genuine'] = mask.ravel()
+  return (numpy.array(model_ids, dtype=numpy.int64), numpy.array(probe_ids, dtype=numpy.int64), trials)
+
+
+class ProtocolIndex(object):
+  """Plain-data index of the files and protocol memberships of the database.
+
+  Keyword Parameters:
+
+  files
+    An iterable of ``(id, client_id, path, session_id, darkened, shot_id)``
+    tuples, one for each file of the database.
+
+  clients
+    An iterable of ``(id, group)`` tuples, one for each client.
+
+  protocols
+    An iterable with the names of all protocols.
+
+  memberships
+    An iterable of ``(protocol, group, purpose, file_id)`` tuples, one for each
+    entry of the protocol purpose <-> file association table.
+  """
+
+  def __init__(self, files, clients, protocols, memberships):
+    self.files = dict((f[0], tuple(f)) for f in files)
+    self.clients = dict(clients)
+    self.protocols = tuple(protocols)
+
+    # (protocol, group, purpose, client group) -> ids of the files, in the
+    # order used by the SQL queries
+    index = {}
+    for protocol, group, purpose, file_id in memberships:
+      client_group = self.clients[self.files[file_id][1]]
+      index.setdefault((protocol, group, purpose, client_group), set()).add(file_id)
+    self.memberships = dict((k, tuple(sorted(v, key=self.sort_key))) for k, v in index.items())
+
+  def sort_key(self, file_id):
+    """Sort key of a file, i.e., (client_id, session_id, darkened, shot_id)"""
+    f = self.files[file_id]
+    return (f[1], f[3], f[4], f[5], f[0])
+
+  def client_id(self, file_id):
+    """Returns the id of the client the given file belongs to"""
+    return self.files[file_id][1]
+
+  def _files(self, protocols, groups, purposes, client_groups):
+    """Iterates over the ids of the files of the given protocol purposes and
+    client groups. If ``purposes`` is ``None``, all purposes are considered."""
+    for (protocol, group, purpose, client_group), ids in self.memberships.items():
+      if protocol in protocols and group in groups and client_group in client_groups and \
+         (purposes is None or purpose in purposes):
+        for file_id in ids:
+          yield file_id
+
+  def select(self, protocols, purposes, model_ids, groups, classes):
+    """Returns the ids of the files which correspond to the given query.
+
+    The parameters must already be validated as done by
+    :py:meth:`bob.db.xm2vts.Database.objects`, whose semantics are reproduced
+    exactly. The ids are sorted by (client_id, session_id, darkened, shot_id).
+    """
+
+    model_set = set(int(m) for m in model_ids)
+
+    def _of_models(ids):
+      if not model_set:
+        return ids
+      return (i for i in ids if self.client_id(i) in model_set)
+
+    retval = set()
+    if 'world' in groups:
+      retval.update(_of_models(self._files(protocols, ('world',), None, ('client',))))
+
+    if ('dev' in groups or 'eval' in groups):
+      if('enroll' in purposes):
+        retval.update(_of_models(self._files(protocols, groups, ('enroll',), ('client',))))
+
+      if('probe' in purposes):
+        if('client' in classes):
+          retval.update(_of_models(self._files(protocols, groups, ('probe',), ('client',))))
+
+        # Exhaustive tests using the impostor{Dev,Eval} sets -> no need to
+        # check for model_ids
+        if('impostor' in classes):
+          impostor_groups = []
+          if('dev' in groups):
+            impostor_groups.append('impostorDev')
+          if('eval' in groups):
+            impostor_groups.append('impostorEval')
+          retval.update(self._files(protocols, groups, ('probe',), impostor_groups))
+
+          # 'client-impostor' samples, excluding the claimed client when a
+          # single model is requested
+          ids = self._files(protocols, groups, ('probe',), ('client',))
+          if(len(model_ids) == 1):
+            ids = (i for i in ids if self.client_id(i) not in model_set)
+          retval.update(ids)
+
+    return sorted(retval, key=self.sort_key)
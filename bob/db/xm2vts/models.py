@@ -21,7 +21,7 @@
 
 import os, numpy
 import bob.db.base.utils
-from sqlalchemy import Table, Column, Integer, String, ForeignKey, or_, and_, not_
+from sqlalchemy import Table, Column, Index, Integer, String, ForeignKey, or_, and_, not_
 from bob.db.base.sqlalchemy_migration import Enum, relationship
 from sqlalchemy.orm import backref
 from sqlalchemy.ext.declarative import declarative_base
@@ -31,8 +31,8 @@ import bob.db.base
 Base = declarative_base()
 
 protocolPurpose_file_association = Table('protocolPurpose_file_association', Base.metadata,
-  Column('protocolPurpose_id', Integer, ForeignKey('protocolPurpose.id')),
-  Column('file_id',  Integer, ForeignKey('file.id')))
+  Column('protocolPurpose_id', Integer, ForeignKey('protocolPurpose.id'), index=True),
+  Column('file_id',  Integer, ForeignKey('file.id'), index=True))
 
 class Client(Base):
   """Database clients, marked by an integer identifier and the group they belong to"""
@@ -46,7 +46,7 @@ class Client(Base):
   # They are split into client, impostorDev and impostorEval (resp. labeled
   # "impostor evaluation" and "impostor test" in the original paper describing the database)
   group_choices = ('client','impostorDev','impostorEval')
-  sgroup = Column(Enum(*group_choices)) # do NOT use group (SQL keyword)
+  sgroup = Column(Enum(*group_choices), index=True) # do NOT use group (SQL keyword)
 
   def __init__(self, id, group):
     self.id = id
@@ -59,11 +59,13 @@ class File(Base, bob.db.base.File):
   """Generic file container"""
 
   __tablename__ = 'file'
+  # The files are selected by their session, darkened and shot attributes
+  __table_args__ = (Index('ix_file_session_darkened_shot', 'session_id', 'darkened', 'shot_id'),)
 
   # Key identifier for the file
   id = Column(Integer, primary_key=True)
   # Key identifier of the client associated with this file
-  client_id = Column(Integer, ForeignKey('client.id')) # for SQL
+  client_id = Column(Integer, ForeignKey('client.id'), index=True) # for SQL
   # Unique path to this file inside the database
   path = Column(String(100), unique=True)
   # Session identifier
@@ -92,7 +94,7 @@ class Annotation(Base):
   __tablename__ = 'annotation'
 
   id = Column(Integer, primary_key=True)
-  file_id = Column(Integer, ForeignKey('file.id'))
+  file_id = Column(Integer, ForeignKey('file.id'), index=True)
 
   le_x = Column(Integer) # left eye
   le_y = Column(Integer)
@@ -116,6 +118,27 @@ class Annotation(Base):
     return "<Annotation('%s': 'reye'=%dx%d, 'leye'=%dx%d)>" % (self.file_id, self.re_y, self.re_x, self.le_y, self.le_x)
 
 
+class AnnotationFile(Base):
+  """Annotation files, which have been read into the annotation table, together
+  with their modification time and size when they were read. These allow to
+  update the annotations incrementally, reading only the files that changed."""
+  __tablename__ = 'annotationFile'
+
+  path = Column(String(200), primary_key=True)
+  file_id = Column(Integer, ForeignKey('file.id'), index=True)
+  mtime = Column(Integer) # in nanoseconds
+  size = Column(Integer)
+
+  def __init__(self, path, file_id, mtime, size):
+    self.path = path
+    self.file_id = file_id
+    self.mtime = mtime
+    self.size = size
+
+  def __repr__(self):
+    return "<AnnotationFile('%s': file %s)>" % (self.path, self.file_id)
+
+
 class Protocol(Base):
   """XM2VTS protocols"""
 
@@ -136,6 +159,8 @@ class ProtocolPurpose(Base):
   """XM2VTS protocol purposes"""
 
   __tablename__ = 'protocolPurpose'
+  # The protocol purposes are selected by their protocol, group and purpose
+  __table_args__ = (Index('ix_protocolPurpose_protocol_sgroup_purpose', 'protocol_id', 'sgroup', 'purpose'),)
 
   # Unique identifier for this protocol purpose object
   id = Column(Integer, primary_key=True)
@@ -22,13 +22,35 @@ XM2VTS database in the most obvious ways.
 
 import os
 import six
+import tempfile
+import numpy
 from bob.db.base import utils
 from .models import *
+from .records import FileRecord, ClientRecord
+from .index import COHORT_GROUPS, TRIAL_FIELDS, check_shard, make_trials, shard_clients
 from .driver import Interface
 
 import bob.db.base
+from sqlalchemy.orm import joinedload
+from collections.abc import Iterable
+from sqlalchemy.orm.exc import NoResultFound
 
-SQLITE_FILE = Interface().files()[0]
+
+_sqlite_file_name = None
+
+def _sqlite_file():
+  """Returns the location of the SQLite database file, which is only looked up
+  when required, since this requires pkg_resources"""
+  global _sqlite_file_name
+  if _sqlite_file_name is None:
+    _sqlite_file_name = Interface().files()[0]
+  return _sqlite_file_name
+
+def __getattr__(name):
+  # keeps SQLITE_FILE available as a (lazy) module attribute
+  if name == 'SQLITE_FILE':
+    return _sqlite_file()
+  raise AttributeError("module '%s' has no attribute '%s'" % (__name__, name))
 
 
 class Database(bob.db.base.SQLiteDatabase):
@@ -36,12 +58,90 @@ class Database(bob.db.base.SQLiteDatabase):
 
   It provides many different ways to probe for the characteristics of the data
   and for the data itself inside the database.
+
+  Keyword Parameters:
+
+  original_directory, original_extension
+    The directory and extension of the original data, see
+    :py:class:`bob.db.base.SQLiteDatabase`.
+
+  use_index
+    If set, the protocol memberships of all files are loaded into memory the
+    first time :py:meth:`objects` is called, and all queries are answered from
+    this index without any further SQL round trip.
+
+  lightweight
+    If set, :py:meth:`objects`, :py:meth:`iter_objects`, :py:meth:`clients`
+    and :py:meth:`reverse` return immutable :py:class:`.FileRecord` and
+    :py:class:`.ClientRecord` objects, which are not tracked by the SQL
+    session, instead of :py:class:`.File` and :py:class:`.Client` objects.
   """
 
-  def __init__(self, original_directory=None, original_extension='.ppm'):
+  # the columns of the File table, which are stored in a FileRecord
+  _file_columns = (File.id, File.client_id, File.path, File.session_id, File.darkened, File.shot_id)
+
+  def __init__(self, original_directory=None, original_extension='.ppm',
+               use_index=False, lightweight=False):
     # call base class constructor
-    super(Database, self).__init__(SQLITE_FILE, File,
+    super(Database, self).__init__(_sqlite_file(), File,
                                    original_directory, original_extension)
+    # if enabled, objects() is answered by an in-memory index built on first use
+    self.m_use_index = use_index
+    self.m_lightweight = lightweight
+    # data read once from the database, see clear_cache()
+    self.clear_cache()
+
+  def clear_cache(self):
+    """Clears all data cached by this object, so that it is read again from
+    the database when required, e.g., after the database has been re-created."""
+
+    self.m_index = None
+    self.m_index_files = None
+    self.m_clients = None
+    self.m_protocols = None
+    self.m_paths = None
+    self.m_cohorts = {}
+    self.m_trials = {}
+
+  def _client_cache(self):
+    """Returns the cached client table as a tuple ``(clients, by_id,
+    by_group)`` of the list of clients ordered by id, a dictionary id ->
+    client and a dictionary group -> sorted list of client ids. The table is
+    read the first time it is required."""
+
+    if self.m_clients is None:
+      if self.m_lightweight:
+        clients = [ClientRecord(*c) for c in self.query(Client.id, Client.sgroup).order_by(Client.id)]
+      else:
+        clients = self.query(Client).order_by(Client.id).all()
+      by_group = dict((group, []) for group in self.client_groups())
+      for c in clients:
+        by_group.setdefault(c.sgroup, []).append(c.id)
+      self.m_clients = (clients, dict((c.id, c) for c in clients), by_group)
+    return self.m_clients
+
+  def _index(self):
+    """Returns the in-memory :py:class:`bob.db.xm2vts.index.ProtocolIndex`,
+    which is built with a few queries the first time it is required."""
+
+    if self.m_index is None:
+      from .index import ProtocolIndex
+      if self.m_lightweight:
+        files = [FileRecord(*f) for f in self.query(*self._file_columns).order_by(File.id)]
+      else:
+        files = self.query(File).options(joinedload(File.client), joinedload(File.annotation)).\
+            order_by(File.id).all()
+      clients = self.query(Client.id, Client.sgroup)
+      protocols = [p.name for p in self.query(Protocol).order_by(Protocol.id)]
+      memberships = self.query(Protocol.name, ProtocolPurpose.sgroup, ProtocolPurpose.purpose,
+                               protocolPurpose_file_association.c.file_id).\
+          filter(ProtocolPurpose.protocol_id == Protocol.id).\
+          filter(protocolPurpose_file_association.c.protocolPurpose_id == ProtocolPurpose.id)
+      self.m_index = ProtocolIndex(
+          [(f.id, f.client_id, f.path, f.session_id, f.darkened, f.shot_id) for f in files],
+          list(clients), protocols, list(memberships))
+      self.m_index_files = dict((f.id, f) for f in files)
+    return self.m_index
 
   def __group_replace_alias__(self, l):
     """Replace 'dev' by 'client' and 'eval' by 'client' in a list of groups, and
@@ -69,7 +169,7 @@ class Database(bob.db.base.SQLiteDatabase):
 
     return Client.group_choices
 
-  def clients(self, protocol=None, groups=None):
+  def clients(self, protocol=None, groups=None, load=None):
     """Returns a list of :py:class:`.Client` for the specific query by the user.
 
     Keyword Parameters:
@@ -83,18 +183,29 @@ class Database(bob.db.base.SQLiteDatabase):
       Note that 'dev', 'eval' and 'world' are alias for 'client'.
       If no groups are specified, then both clients are impostors are listed.
 
+    load
+      The relationships of the clients ('files',), which are loaded together
+      with the clients instead of issuing one query per client when accessed.
+      This field is ignored in lightweight mode.
+
     Returns: A list containing all the clients which have the given properties.
     """
 
     groups = self.__group_replace_alias__(groups)
     groups = self.check_parameters_for_validity(
         groups, "group", self.client_groups())
-    # List of the clients
-    q = self.query(Client)
+    if load and not self.m_lightweight:
+      # List of the clients, with their relationships
+      q = self.query(Client).options(*self._load_options(Client, load, ('files',)))
+      if groups:
+        q = q.filter(Client.sgroup.in_(groups))
+      return list(q.order_by(Client.id))
+
+    # List of the clients from the cache
+    clients = self._client_cache()[0]
     if groups:
-      q = q.filter(Client.sgroup.in_(groups))
-    q = q.order_by(Client.id)
-    return list(q)
+      return [c for c in clients if c.sgroup in groups]
+    return list(clients)
 
   def models(self, protocol=None, groups=None):
     """Returns a list of :py:class:`.Client` for the specific query by the user.
@@ -134,21 +245,28 @@ class Database(bob.db.base.SQLiteDatabase):
              to the given group.
     """
 
-    return [client.id for client in self.clients(protocol, groups)]
+    groups = self.__group_replace_alias__(groups)
+    groups = self.check_parameters_for_validity(
+        groups, "group", self.client_groups())
+    by_group = self._client_cache()[2]
+    return sorted(i for group in set(groups) for i in by_group.get(group, ()))
 
   def has_client_id(self, id):
     """Returns True if we have a client with a certain integer identifier"""
 
-    return self.query(Client).filter(Client.id == id).count() != 0
+    return id in self._client_cache()[1]
 
   def client(self, id):
     """Returns the client object in the database given a certain id. Raises
     an error if that does not exist."""
 
-    return self.query(Client).filter(Client.id == id).one()
+    by_id = self._client_cache()[1]
+    if id not in by_id:
+      raise NoResultFound("No client with id '%s'" % (id,))
+    return by_id[id]
 
   def objects(self, protocol=None, purposes=None, model_ids=None, groups=None,
-              classes=None):
+              classes=None, load=None, shard=None, shard_by='file'):
     """Returns a list of :py:class:`.File` for the specific query by the user.
 
     Keyword Parameters:
@@ -177,59 +295,148 @@ class Database(bob.db.base.SQLiteDatabase):
       or a tuple with several of them. If 'None' is given (this is the
       default), it is considered the same as a tuple with all possible values.
 
-    Returns: A list of :py:class:`.File` objects.
+    load
+      The relationships of the files ('client', 'annotation') or a tuple with
+      several of them, which are loaded together with the files instead of
+      issuing one query per file when accessed. This field is ignored in
+      lightweight mode.
+
+    shard
+      A tuple ``(k, n)`` with ``0 <= k < n``, which only retrieves the k-th of
+      n disjoint parts of the files, e.g., to distribute the files over n
+      parallel jobs. The parts are stable and computed by the database, which
+      never returns the files of the other parts. If 'None' is given (this is
+      the default), all files are retrieved.
+
+    shard_by
+      How the files are distributed over the shards: 'file' (the default)
+      distributes them by file id, while 'client' keeps all files of a
+      client in the same shard. In the latter case, the clients of the client
+      groups which the query can return (ordered by id) are dealt round-robin
+      over the shards, so that the shards have the same number of these
+      clients up to one, whatever the gaps between their ids.
+
+    Returns: A list of :py:class:`.File` objects, in the order of :py:meth:`iter_objects`.
+    """
+
+    return list(self.iter_objects(protocol, purposes, model_ids, groups, classes, load, shard, shard_by))
+
+  def iter_objects(self, protocol=None, purposes=None, model_ids=None, groups=None,
+                   classes=None, load=None, shard=None, shard_by='file'):
+    """Iterates over the :py:class:`.File` objects for the specific query by
+    the user.
+
+    The parameters are identical to the ones of :py:meth:`objects`. Contrary
+    to :py:meth:`objects`, the files are yielded while the results are read
+    from the database. Files are returned without duplicates in a stable
+    order, sorted by (client_id, session_id, darkened, shot_id).
+
+    Returns: A generator of :py:class:`.File` objects.
     """
 
+    # the parameters are checked immediately, not at the first iteration
+    protocol, purposes, model_ids, groups, classes = self._check_objects_parameters(
+        protocol, purposes, model_ids, groups, classes)
+    options = self._load_options(File, load, ('client', 'annotation'))
+    shard = check_shard(shard, shard_by)
+
+    if self.m_use_index:
+      # the files of the index are always loaded with their relationships
+      index = self._index()
+      ids = index.select(protocol, purposes, model_ids, groups, classes)
+      if shard is not None and shard_by == 'client':
+        clients = shard_clients(self._client_cache()[0], shard, purposes, groups, classes)
+        ids = [i for i in ids if index.client_id(i) in clients]
+      elif shard is not None:
+        ids = [i for i in ids if i % shard[1] == shard[0]]
+      return (self.m_index_files[i] for i in ids)
+
+    if self.m_lightweight:
+      q = self._objects_query(self._file_columns, protocol, purposes, model_ids, groups, classes)
+      q = self._shard_query(q, shard, shard_by, purposes, groups, classes)
+      return (FileRecord(*f) for f in self._iter_query(q))
+
+    q = self._objects_query((File,), protocol, purposes, model_ids, groups, classes)
+    q = self._shard_query(q, shard, shard_by, purposes, groups, classes)
+    if q is not None and options:
+      q = q.options(*options)
+    return self._iter_query(q)
+
+  def _shard_query(self, query, shard, shard_by, purposes, groups, classes):
+    """Restricts the given query of :py:meth:`_objects_query` to the given
+    checked shard of the query with the given checked parameters"""
+
+    if query is None or shard is None:
+      return query
+    if shard_by == 'client':
+      clients = shard_clients(self._client_cache()[0], shard, purposes, groups, classes)
+      return query.filter(File.client_id.in_(sorted(clients)))
+    k, n = shard
+    return query.filter(File.id % n == k)
+
+  def _load_options(self, entity, load, choices):
+    """Returns the options to eagerly load the given relationships of the entity"""
+
+    if not load:
+      return []
+    load = self.check_parameters_for_validity(load, "relationship", choices)
+    return [joinedload(getattr(entity, name)) for name in load]
+
+  def _iter_query(self, query):
+    """Streams the results of the given query, which might be ``None``"""
+
+    if query is None:
+      return
+    for f in query.yield_per(100):
+      yield f
+
+  def _check_objects_parameters(self, protocol, purposes, model_ids, groups, classes):
+    """Validates the parameters of :py:meth:`objects` and returns them as tuples"""
+
+    protocol_names = self._index().protocols if self.m_use_index else self.protocol_names()
     protocol = self.check_parameters_for_validity(
-        protocol, "protocol", self.protocol_names())
+        protocol, "protocol", protocol_names)
     purposes = self.check_parameters_for_validity(
         purposes, "purpose", self.purposes())
     groups = self.check_parameters_for_validity(groups, "group", self.groups())
     classes = self.check_parameters_for_validity(
         classes, "class", ('client', 'impostor'))
 
-    import collections
     if(model_ids is None):
       model_ids = ()
-    elif(not isinstance(model_ids, collections.Iterable)):
+    elif(not isinstance(model_ids, Iterable)):
       model_ids = (model_ids,)
 
-    # Now query the database
-    retval = []
+    return protocol, purposes, model_ids, groups, classes
+
+  def _objects_query(self, entities, protocol, purposes, model_ids, groups, classes):
+    """Returns a single (not yet executed) query of the given entities, which
+    corresponds to the given checked parameters of :py:meth:`objects`. The different parts of the
+    request are combined into one condition, so that all files are retrieved
+    in a single round trip. Returns ``None`` if no file can match."""
+
+    conditions = []
     if 'world' in groups:
-      q = self.query(File).join(Client).join((ProtocolPurpose, File.protocolPurposes)).join(Protocol).\
-          filter(Client.sgroup == 'client').\
-          filter(and_(Protocol.name.in_(protocol),
-                      ProtocolPurpose.sgroup == 'world'))
+      c = and_(Client.sgroup == 'client', ProtocolPurpose.sgroup == 'world')
       if model_ids:
-        q = q.filter(Client.id.in_(model_ids))
-      q = q.order_by(File.client_id, File.session_id,
-                     File.darkened, File.shot_id)
-      retval += list(q)
+        c = and_(c, Client.id.in_(model_ids))
+      conditions.append(c)
 
     if ('dev' in groups or 'eval' in groups):
       if('enroll' in purposes):
-        q = self.query(File).join(Client).join((ProtocolPurpose, File.protocolPurposes)).join(Protocol).\
-            filter(Client.sgroup == 'client').\
-            filter(and_(Protocol.name.in_(protocol), ProtocolPurpose.sgroup.in_(
-                groups), ProtocolPurpose.purpose == 'enroll'))
+        c = and_(Client.sgroup == 'client', ProtocolPurpose.sgroup.in_(groups),
+                 ProtocolPurpose.purpose == 'enroll')
         if model_ids:
-          q = q.filter(Client.id.in_(model_ids))
-        q = q.order_by(File.client_id, File.session_id,
-                       File.darkened, File.shot_id)
-        retval += list(q)
+          c = and_(c, Client.id.in_(model_ids))
+        conditions.append(c)
 
       if('probe' in purposes):
         if('client' in classes):
-          q = self.query(File).join(Client).join((ProtocolPurpose, File.protocolPurposes)).join(Protocol).\
-              filter(Client.sgroup == 'client').\
-              filter(and_(Protocol.name.in_(protocol), ProtocolPurpose.sgroup.in_(
-                  groups), ProtocolPurpose.purpose == 'probe'))
+          c = and_(Client.sgroup == 'client', ProtocolPurpose.sgroup.in_(groups),
+                   ProtocolPurpose.purpose == 'probe')
           if model_ids:
-            q = q.filter(Client.id.in_(model_ids))
-          q = q.order_by(File.client_id, File.session_id,
-                         File.darkened, File.shot_id)
-          retval += list(q)
+            c = and_(c, Client.id.in_(model_ids))
+          conditions.append(c)
 
         # Exhaustive tests using the impostor{Dev,Eval} sets -> no need to
         # check for model_ids
@@ -239,27 +446,178 @@ class Database(bob.db.base.SQLiteDatabase):
             ltmp.append('impostorDev')
           if('eval' in groups):
             ltmp.append('impostorEval')
-          impostorGroups = tuple(ltmp)
-          q = self.query(File).join(Client).join((ProtocolPurpose, File.protocolPurposes)).join(Protocol).\
-              filter(Client.sgroup.in_(ltmp)).\
-              filter(and_(Protocol.name.in_(protocol), ProtocolPurpose.sgroup.in_(
-                  groups), ProtocolPurpose.purpose == 'probe'))
-          q = q.order_by(File.client_id, File.session_id,
-                         File.darkened, File.shot_id)
-          retval += list(q)
+          conditions.append(and_(Client.sgroup.in_(ltmp), ProtocolPurpose.sgroup.in_(groups),
+                                 ProtocolPurpose.purpose == 'probe'))
 
           # Needs to add 'client-impostor' samples
-          q = self.query(File).join(Client).join((ProtocolPurpose, File.protocolPurposes)).join(Protocol).\
-              filter(Client.sgroup == 'client').\
-              filter(and_(Protocol.name.in_(protocol), ProtocolPurpose.sgroup.in_(
-                  groups), ProtocolPurpose.purpose == 'probe'))
+          c = and_(Client.sgroup == 'client', ProtocolPurpose.sgroup.in_(groups),
+                   ProtocolPurpose.purpose == 'probe')
           if(len(model_ids) == 1):
-            q = q.filter(not_(Client.id.in_(model_ids)))
-          q = q.order_by(File.client_id, File.session_id,
-                         File.darkened, File.shot_id)
-          retval += list(q)
+            c = and_(c, not_(Client.id.in_(model_ids)))
+          conditions.append(c)
+
+    if not conditions:
+      return None
+
+    return self.query(*entities).join(Client).join((ProtocolPurpose, File.protocolPurposes)).join(Protocol).\
+        filter(Protocol.name.in_(protocol)).\
+        filter(or_(*conditions)).\
+        distinct().\
+        order_by(File.client_id, File.session_id, File.darkened, File.shot_id)
+
+  def probe_matrix(self, protocol, group='dev'):
+    """Returns the probe files of the given protocol and group, together with
+    the labels of all model/probe pairs.
+
+    The XM2VTS protocols are exhaustive, i.e., each model of a group is
+    compared to the same list of probe files. This function returns this list
+    once instead of calling :py:meth:`objects` for each model.
+
+    Keyword Parameters:
+
+    protocol
+      One of the XM2VTS protocols ('lp1', 'lp2', 'darkened-lp1', 'darkened-lp2').
+
+    group
+      One of the groups ('dev', 'eval').
 
-    return list(set(retval))  # To remove duplicates
+    Returns: A tuple ``(model_ids, probes, mask)``, where ``model_ids`` is the
+    list of model ids of the group, ``probes`` the list of probe
+    :py:class:`.File` objects shared by all models, and ``mask`` a boolean
+    :py:class:`numpy.ndarray` of shape ``(len(model_ids), len(probes))``,
+    which is ``True`` for client accesses and ``False`` for impostor accesses.
+    """
+
+    if group not in ('dev', 'eval'):
+      raise ValueError("Invalid group '%s'. Valid values are 'dev' or 'eval'" % (group,))
+
+    probes = self.objects(protocol=protocol, groups=group, purposes='probe')
+    model_ids = self.model_ids(protocol, group)
+    mask = numpy.equal.outer(numpy.array(model_ids, dtype=numpy.int64),
+                             numpy.array([f.client_id for f in probes], dtype=numpy.int64))
+    return model_ids, probes, mask
+
+  # the layout of the trials returned by trial_list()
+  trial_dtype = numpy.dtype(TRIAL_FIELDS)
+
+  def trial_list(self, protocol, group='dev'):
+    """Returns all (model, probe) pairs which are compared in the given
+    protocol and group, in a compact layout that allows to allocate a dense
+    score matrix up front.
+
+    The trials are computed once from :py:meth:`probe_matrix` and cached in
+    memory and in a ``.npz`` file next to the SQLite database, which is
+    recomputed whenever the modification time or size of the database change,
+    and removed by the ``create`` and ``update`` commands. If the file cannot be
+    written (e.g. in a read-only installation), the trials are only cached in
+    memory.
+
+    Keyword Parameters:
+
+    protocol
+      One of the XM2VTS protocols ('lp1', 'lp2', 'darkened-lp1', 'darkened-lp2').
+
+    group
+      One of the groups ('dev', 'eval').
+
+    Returns: A tuple ``(model_ids, probe_ids, trials)``, where ``model_ids``
+    and ``probe_ids`` are ``int64`` arrays with the ids of the models and of
+    the probe files, and ``trials`` a structured array of :py:attr:`trial_dtype`
+    with the fields ``model_index`` and ``probe_index`` (indexes into
+    ``model_ids`` and ``probe_ids``) and ``is_genuine``. The trials are
+    ordered by model, then by probe, i.e., they are the entries of the
+    ``(len(model_ids), len(probe_ids))`` score matrix in row-major order.
+    """
+
+    if not self.has_protocol(protocol):
+      raise ValueError("Invalid protocol '%s'. Valid values are %s" % (protocol, self.protocol_names()))
+    if group not in ('dev', 'eval'):
+      raise ValueError("Invalid group '%s'. Valid values are 'dev' or 'eval'" % (group,))
+
+    key = (protocol, group)
+    if key not in self.m_trials:
+      from .create import trials_file
+      filename = trials_file(self.m_sqlite_file, protocol, group)
+      st = os.stat(self.m_sqlite_file)
+      stamp = numpy.array([st.st_mtime_ns, st.st_size], dtype=numpy.int64)
+      try:
+        with numpy.load(filename) as data:
+          if not numpy.array_equal(data['stamp'], stamp):
+            raise ValueError("The trials in '%s' are outdated" % filename)
+          trials = (data['model_ids'], data['probe_ids'], data['trials'])
+      except Exception:
+        # a missing, outdated or unreadable file is (re-)computed
+        model_ids, probes, mask = self.probe_matrix(protocol, group)
+        trials = make_trials(model_ids, [f.id for f in probes], mask)
+        try:
+          # concurrent writers use different temporary files, and readers never
+          # see partial files
+          fd, tmpfile = tempfile.mkstemp(prefix='.trials-', suffix='.npz', dir=os.path.dirname(filename))
+        except (IOError, OSError):
+          pass
+        else:
+          try:
+            with os.fdopen(fd, 'wb') as f:
+              numpy.savez(f, stamp=stamp, model_ids=trials[0], probe_ids=trials[1], trials=trials[2])
+            os.replace(tmpfile, filename)
+          except (IOError, OSError):
+            os.remove(tmpfile)
+      self.m_trials[key] = trials
+    return self.m_trials[key]
+
+  def files_table(self):
+    """Returns all files of the database as a structured array, which allows
+    to select files with vectorized operations instead of loops over
+    :py:class:`.File` objects.
+
+    The array contains one row per file, ordered by id, with the fields:
+
+    ``id``, ``client_id``, ``session_id``, ``shot_id``
+      The integral attributes of the :py:class:`.File`.
+
+    ``darkened``
+      The darkened attribute ('n', 'l' or 'r') of the :py:class:`.File`.
+
+    ``client_group``
+      The index of the group of the client in :py:meth:`client_groups`.
+
+    ``path``
+      The path of the :py:class:`.File`.
+
+    ``purposes``
+      A bitmask of the protocol purposes the file belongs to, where the bit
+      ``k`` corresponds to the ``k``-th element of :py:meth:`protocol_purposes`.
+
+    Returns: A :py:class:`numpy.ndarray` with the above fields.
+    """
+
+    purpose_ids = [pu.id for pu in self.protocol_purposes()]
+    if len(purpose_ids) > 64:
+      raise ValueError("Too many protocol purposes (%d) for a 64 bit mask" % len(purpose_ids))
+    bits = dict((pu_id, numpy.uint64(1) << numpy.uint64(k)) for k, pu_id in enumerate(purpose_ids))
+    client_groups = self.client_groups()
+
+    files = self.query(File.id, File.client_id, File.session_id, File.shot_id, File.darkened,
+                       Client.sgroup, File.path).\
+        filter(File.client_id == Client.id).\
+        order_by(File.id).all()
+    path_length = max([len(f[6]) for f in files] or [1])
+
+    table = numpy.zeros(len(files), dtype=[
+        ('id', numpy.int32), ('client_id', numpy.int32), ('session_id', numpy.int8),
+        ('shot_id', numpy.int8), ('darkened', 'U1'), ('client_group', numpy.int8),
+        ('path', 'U%d' % path_length), ('purposes', numpy.uint64)])
+    for i, f in enumerate(files):
+      table[i] = (f[0], f[1], f[2], f[3], f[4], client_groups.index(f[5]), f[6], 0)
+
+    # sets the bits of the protocol purposes
+    rows = dict((f[0], i) for i, f in enumerate(files))
+    associations = self.query(protocolPurpose_file_association.c.file_id,
+                              protocolPurpose_file_association.c.protocolPurpose_id)
+    for file_id, purpose_id in associations:
+      table['purposes'][rows[file_id]] |= bits[purpose_id]
+
+    return table
 
   def annotations(self, file):
     """Returns the annotations for the image with the given file id.
@@ -273,43 +631,295 @@ class Database(bob.db.base.SQLiteDatabase):
     """
 
     self.assert_validity()
+    if self.m_lightweight:
+      annotation = self.query(Annotation).filter(Annotation.file_id == file.id).\
+          order_by(Annotation.id).first()
+      return annotation() if annotation is not None else None
     # return the annotations as returned by the call function of the
     # Annotation object
     return file.annotation()
 
+  def annotations_bulk(self, files):
+    """Returns the annotations for a list of files, retrieved in a single query.
+
+    Keyword Parameters:
+
+    files
+      The list of ``File`` objects (or file ids) to retrieve the annotations for.
+
+    Returns: A tuple ``(annotations, missing)``, where ``annotations`` is an
+    integral :py:class:`numpy.ndarray` of shape ``(len(files), 4)`` containing
+    the eye positions ``(re_y, re_x, le_y, le_x)`` of the files, in the order
+    of the input, and ``missing`` a boolean :py:class:`numpy.ndarray`, which is
+    ``True`` for the files without annotations (the positions of which are 0).
+    """
+
+    ids = [getattr(f, 'id', f) for f in files]
+
+    q = self.query(Annotation.file_id, Annotation.re_y, Annotation.re_x, Annotation.le_y, Annotation.le_x)
+    # for large requests, reading the whole table avoids too many SQL variables
+    if len(ids) <= 500:
+      q = q.filter(Annotation.file_id.in_(ids))
+    positions = {}
+    for a in q.order_by(Annotation.id):
+      positions.setdefault(a[0], a[1:])
+
+    annotations = numpy.zeros((len(ids), 4), dtype=numpy.int32)
+    missing = numpy.ones(len(ids), dtype=bool)
+    for i, file_id in enumerate(ids):
+      if file_id in positions:
+        annotations[i] = positions[file_id]
+        missing[i] = False
+    return annotations, missing
+
+  def reverse(self, paths, preserve_order=True):
+    """Reverses the lookup: from certain paths, return a list of files
+
+    Keyword Parameters:
+
+    paths
+      The filename stems to query for. This object should be a python
+      iterable (such as a tuple or list)
+
+    preserve_order
+      If True (the default) the order of elements is preserved, but the
+      execution time increases.
+
+    Returns: A list of files, which are :py:class:`.FileRecord` objects in
+    lightweight mode.
+    """
+
+    if not self.m_lightweight:
+      return super(Database, self).reverse(paths, preserve_order)
+
+    paths = list(paths)
+    records = {}
+    # limit the number of SQL variables per query
+    for i in range(0, len(paths), 500):
+      q = self.query(*self._file_columns).filter(File.path.in_(paths[i:i + 500]))
+      records.update((f[2], FileRecord(*f)) for f in q)
+    if not preserve_order:
+      return list(records.values())
+    return [records[p] for p in paths if p in records]
+
+  def _path_cache(self):
+    """Returns the cached path index as a tuple ``(ids, paths, by_path)`` of
+    the sorted array of file ids, the array of the corresponding path stems and
+    a dictionary path stem -> file id. The index is read with a single query
+    the first time it is required."""
+
+    if self.m_paths is None:
+      rows = self.query(File.id, File.path).order_by(File.id).all()
+      ids = numpy.array([r[0] for r in rows], dtype=numpy.int64)
+      paths = numpy.empty(len(rows), dtype=object)
+      paths[:] = [str(r[1]) for r in rows]
+      self.m_paths = (ids, paths, dict((str(r[1]), r[0]) for r in rows))
+    return self.m_paths
+
+  def reverse_bulk(self, paths):
+    """Translates many path stems into file ids at once
+
+    Keyword Parameters:
+
+    paths
+      An iterable (or a :py:class:`numpy.ndarray`) of path stems
+
+    Returns: A :py:class:`numpy.ndarray` of ``int64`` with the ids of the
+    files, in the order of ``paths``, where unknown stems are set to ``-1``.
+    """
+
+    by_path = self._path_cache()[2]
+    return numpy.array([by_path.get(str(p), -1) for p in paths], dtype=numpy.int64)
+
+  def paths_bulk(self, ids, prefix='', suffix=''):
+    """Translates many file ids into paths at once
+
+    Keyword Parameters:
+
+    ids
+      An iterable (or a :py:class:`numpy.ndarray`) of file ids
+
+    prefix
+      An optional directory name that will be prefixed to the returned paths.
+
+    suffix
+      An optional extension that will be suffixed to the returned paths.
+
+    Returns: A :py:class:`numpy.ndarray` of ``object``, with the paths of the
+    files in the order of ``ids``, where unknown ids are set to ``None``.
+    """
+
+    all_ids, all_paths = self._path_cache()[:2]
+    ids = numpy.asarray(list(ids) if not isinstance(ids, numpy.ndarray) else ids, dtype=numpy.int64).ravel()
+    positions = numpy.searchsorted(all_ids, ids)
+    found = positions < len(all_ids)
+    found[found] = all_ids[positions[found]] == ids[found]
+
+    retval = numpy.empty(len(ids), dtype=object)
+    selected = numpy.empty(int(found.sum()), dtype=object)
+    selected[:] = [os.path.join(prefix, p + suffix) for p in all_paths[positions[found]]]
+    retval[found] = selected
+    return retval
+
+  def _protocol_cache(self):
+    """Returns the cached protocol catalogue as a tuple ``(protocols, by_name,
+    purposes)`` of the list of protocols ordered by id, a dictionary name ->
+    protocol and the list of protocol purposes ordered by id. The catalogue is
+    read the first time it is required."""
+
+    if self.m_protocols is None:
+      protocols = self.query(Protocol).order_by(Protocol.id).all()
+      purposes = self.query(ProtocolPurpose).order_by(ProtocolPurpose.id).all()
+      self.m_protocols = (protocols, dict((str(p.name), p) for p in protocols), purposes)
+    return self.m_protocols
+
   def protocol_names(self):
     """Returns all registered protocol names"""
 
-    l = self.protocols()
-    retval = [str(k.name) for k in l]
-    return retval
+    return [str(k.name) for k in self.protocols()]
 
   def protocols(self):
     """Returns all registered protocols"""
 
-    return list(self.query(Protocol))
+    return list(self._protocol_cache()[0])
 
   def has_protocol(self, name):
     """Tells if a certain protocol is available"""
 
-    return self.query(Protocol).filter(Protocol.name == name).count() != 0
+    return name in self._protocol_cache()[1]
 
   def protocol(self, name):
     """Returns the protocol object in the database given a certain name. Raises
     an error if that does not exist."""
 
-    return self.query(Protocol).filter(Protocol.name == name).one()
+    by_name = self._protocol_cache()[1]
+    if name not in by_name:
+      raise NoResultFound("No protocol with name '%s'" % (name,))
+    return by_name[name]
 
   def protocol_purposes(self):
-    """Returns all registered protocol purposes"""
+    """Returns all registered protocol purposes, ordered by their id"""
 
-    return list(self.query(ProtocolPurpose))
+    return list(self._protocol_cache()[2])
 
   def purposes(self):
     """Returns the list of allowed purposes"""
 
     return ProtocolPurpose.purpose_choices
 
+  def _cohort(self, protocol, group):
+    """Returns the cached T-Norm and Z-Norm cohort of the given protocol and
+    group as a tuple ``(model_ids, t_files, z_files)``, which is computed the
+    first time it is required.
+
+    The cohort models are the impostors of the same group. They are enrolled
+    with their files of the same sessions and shots as the enrollment files of
+    the protocol, and probed with their probe files of the protocol. Hence,
+    the Z-Norm probes are also impostor probes of the group, which is the
+    price of keeping the development and evaluation sets separate: the world
+    set only contains the clients, which are the models themselves."""
+
+    key = (protocol, group)
+    if key not in self.m_cohorts:
+      model_ids = self.model_ids(groups=COHORT_GROUPS[group])
+      cohort = set(model_ids)
+
+      shots = set((f.session_id, f.darkened, f.shot_id) for f in
+          self.iter_objects(protocol=protocol, groups=group, purposes='enroll'))
+      if self.m_lightweight:
+        q = self.query(*self._file_columns)
+      else:
+        q = self.query(File)
+      q = q.filter(File.client_id.in_(model_ids)).order_by(File.client_id, File.session_id, File.darkened, File.shot_id)
+      t_files = [FileRecord(*f) if self.m_lightweight else f for f in q]
+      t_files = [f for f in t_files if (f.session_id, f.darkened, f.shot_id) in shots]
+
+      z_files = [f for f in self.iter_objects(protocol=protocol, groups=group, purposes='probe', classes='impostor')
+                 if f.client_id in cohort]
+      self.m_cohorts[key] = (model_ids, t_files, z_files)
+    return self.m_cohorts[key]
+
+  def _cohorts(self, protocol, groups):
+    """Validates the parameters of the T-Norm and Z-Norm queries and returns
+    the cohorts of all selected protocols and groups"""
+
+    protocol = self.check_parameters_for_validity(protocol, "protocol", self.protocol_names())
+    groups = self.check_parameters_for_validity(groups, "group", ('dev', 'eval'))
+    return [self._cohort(p, g) for p in protocol for g in groups]
+
+  def _of_models(self, files, model_ids):
+    """Returns the given files, restricted to the clients in model_ids (if given)"""
+
+    if model_ids is None:
+      return files
+    if not isinstance(model_ids, Iterable):
+      model_ids = (model_ids,)
+    model_ids = set(model_ids)
+    return [f for f in files if f.client_id in model_ids]
+
+  def tmodel_ids(self, protocol=None, groups=None):
+    """Returns the ids of the T-Norm models of the given protocol and groups,
+    which are the impostors of the same group ('impostorDev' for 'dev' and
+    'impostorEval' for 'eval').
+
+    Keyword Parameters:
+
+    protocol
+      One of the XM2VTS protocols ('lp1', 'lp2', 'darkened-lp1', 'darkened-lp2').
+
+    groups
+      The groups of the models that are normalized ('dev', 'eval')
+
+    Returns: A sorted list of model ids.
+    """
+
+    return sorted(set(i for cohort in self._cohorts(protocol, groups) for i in cohort[0]))
+
+  def tobjects(self, protocol=None, model_ids=None, groups=None):
+    """Returns the enrollment files of the T-Norm models of the given protocol
+    and groups, i.e., the files of the T-Norm models from the same sessions
+    and shots as the enrollment files of the protocol.
+
+    Keyword Parameters:
+
+    protocol
+      One of the XM2VTS protocols ('lp1', 'lp2', 'darkened-lp1', 'darkened-lp2').
+
+    model_ids
+      Only retrieves the files for the provided list of T-Norm model ids. If
+      'None' is given (this is the default), the files of all models are
+      retrieved.
+
+    groups
+      The groups of the models that are normalized ('dev', 'eval')
+
+    Returns: A list of :py:class:`.File` objects.
+    """
+
+    return self._of_models([f for cohort in self._cohorts(protocol, groups) for f in cohort[1]], model_ids)
+
+  def zobjects(self, protocol=None, model_ids=None, groups=None):
+    """Returns the Z-Norm probe files of the given protocol and groups, i.e.,
+    the probe files of the impostors of the same group in the protocol.
+
+    Keyword Parameters:
+
+    protocol
+      One of the XM2VTS protocols ('lp1', 'lp2', 'darkened-lp1', 'darkened-lp2').
+
+    model_ids
+      Only retrieves the files of the provided list of cohort client ids. If
+      'None' is given (this is the default), the files of all cohort clients
+      are retrieved.
+
+    groups
+      The groups of the models that are normalized ('dev', 'eval')
+
+    Returns: A list of :py:class:`.File` objects.
+    """
+
+    return self._of_models([f for cohort in self._cohorts(protocol, groups) for f in cohort[2]], model_ids)
+
   def t_model_ids(self, protocol, groups='dev', **kwargs):
     """Returns the list of model ids used for T-Norm of the given protocol for the given group that satisfy your query.
     For possible keyword arguments, please check the `tmodel_ids` function."""
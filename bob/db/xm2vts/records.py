@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# Copyright (C) 2011-2013 Idiap Research Institute, Martigny, Switzerland
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Lightweight, immutable records of the XM2VTS database, which are returned
+instead of the table models by read-only queries.
+"""
+
+import os
+import collections
+
+
+class FileRecord(collections.namedtuple('FileRecord', ('id', 'client_id', 'path', 'session_id', 'darkened', 'shot_id'))):
+  """Read-only version of a :py:class:`bob.db.xm2vts.File`, which is identified
+  by its id"""
+
+  __slots__ = ()
+
+  def __eq__(self, other):
+    return isinstance(other, FileRecord) and self.id == other.id
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __hash__(self):
+    return hash(self.id)
+
+  def make_path(self, directory=None, extension=None):
+    """Wraps the current path so that a complete path is formed
+
+    Keyword Parameters:
+
+    directory
+      An optional directory name that will be prefixed to the returned result.
+
+    extension
+      An optional extension that will be suffixed to the returned filename. The
+      extension normally includes the leading ``.`` character as in ``.png`` or
+      ``.bmp``. If not specified the default extension for the original file in
+      the database will be used.
+
+    Returns a string containing the newly generated file path.
+    """
+
+    return str(os.path.join(directory or '', self.path + (extension or '')))
+
+
+class ClientRecord(collections.namedtuple('ClientRecord', ('id', 'sgroup'))):
+  """Read-only version of a :py:class:`bob.db.xm2vts.Client`, which is
+  identified by its id"""
+
+  __slots__ = ()
+
+  def __eq__(self, other):
+    return isinstance(other, ClientRecord) and self.id == other.id
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __hash__(self):
+    return hash(self.id)
+
+
+class ProtocolRecord(collections.namedtuple('ProtocolRecord', ('id', 'name'))):
+  """Read-only version of a :py:class:`bob.db.xm2vts.Protocol`"""
+
+  __slots__ = ()
+
+
+class ProtocolPurposeRecord(collections.namedtuple('ProtocolPurposeRecord', ('id', 'protocol', 'sgroup', 'purpose'))):
+  """Read-only version of a :py:class:`bob.db.xm2vts.ProtocolPurpose`, where
+  ``protocol`` is the :py:class:`ProtocolRecord` it belongs to"""
+
+  __slots__ = ()
@@ -0,0 +1,500 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# Copyright (C) 2011-2013 Idiap Research Institute, Martigny, Switzerland
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Snapshot backend of the XM2VTS database, which serves the queries from a
+pre-serialized copy of the SQL database without using SQLAlchemy.
+
+The snapshot is a gzip-compressed JSON file, which is written by
+``bob_dbmanage.py xm2vts create`` or ``bob_dbmanage.py xm2vts snapshot``.
+"""
+
+import os
+import six
+import json
+import gzip
+
+from .index import ProtocolIndex, COHORT_GROUPS, check_shard, make_trials, shard_clients
+from .records import FileRecord, ClientRecord, ProtocolRecord, ProtocolPurposeRecord
+
+# the version of the snapshot format, which is increased at each incompatible change
+SNAPSHOT_VERSION = 1
+
+SNAPSHOT_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'db.snapshot')
+
+
+def save(data, filename):
+  """Writes the given content of the database to a snapshot file.
+
+  Keyword Parameters:
+
+  data
+    A dictionary with the lists of rows of the 'clients', 'files', 'protocols',
+    'protocol_purposes', 'memberships' and 'annotations', and the choices of the
+    'client_groups', 'groups' and 'purposes'.
+
+  filename
+    The name of the snapshot file to write.
+  """
+
+  data = dict(data, version=SNAPSHOT_VERSION)
+  # write to a temporary file first, so that readers never see partial snapshots
+  tmpfile = filename + '.tmp'
+  with gzip.open(tmpfile, 'wt') as f:
+    json.dump(data, f, separators=(',', ':'))
+  os.replace(tmpfile, filename)
+
+
+def load(filename):
+  """Reads the content of the database from the given snapshot file"""
+
+  with gzip.open(filename, 'rt') as f:
+    data = json.load(f)
+  if data.get('version') != SNAPSHOT_VERSION:
+    raise ValueError("The snapshot '%s' has version %s, but version %d is required; "
+                     "please re-create it with 'bob_dbmanage.py xm2vts snapshot'" %
+                     (filename, data.get('version'), SNAPSHOT_VERSION))
+  return data
+
+
+def _check_parameters(parameters, description, valid_parameters):
+  """Validates the given query parameters like
+  :py:meth:`bob.db.base.Database.check_parameters_for_validity`"""
+
+  if parameters is None:
+    return tuple(valid_parameters)
+  if isinstance(parameters, six.string_types):
+    parameters = (parameters,)
+  for parameter in parameters:
+    if parameter not in valid_parameters:
+      raise ValueError("Invalid %s '%s'. Valid values are %s, or lists/tuples of those" %
+                       (description, parameter, valid_parameters))
+  return tuple(set(parameters))
+
+
+class SnapshotDatabase(object):
+  """Provides the query API of :py:class:`bob.db.xm2vts.Database`, which is
+  served from a snapshot of the database.
+
+  All files and clients are returned as :py:class:`.FileRecord` and
+  :py:class:`.ClientRecord` objects, like in the ``lightweight`` mode of
+  :py:class:`bob.db.xm2vts.Database`. The trials of :py:meth:`trial_list` are
+  only cached in memory.
+
+  Keyword Parameters:
+
+  original_directory, original_extension
+    The directory and extension of the original data.
+
+  snapshot_file
+    The snapshot file to read, by default the one next to the SQL database.
+  """
+
+  def __init__(self, original_directory=None, original_extension='.ppm', snapshot_file=None):
+    self.original_directory = original_directory
+    self.original_extension = original_extension
+    self.m_snapshot_file = snapshot_file or SNAPSHOT_FILE
+    self.clear_cache()
+
+  def clear_cache(self):
+    """Reads the snapshot again (if it exists) and clears all data computed
+    from it"""
+
+    self.m_index = None
+    self.m_cohorts = {}
+    self.m_trials = {}
+    if os.path.exists(self.m_snapshot_file):
+      self._load()
+
+  def _load(self):
+    """Reads the snapshot and builds the in-memory tables"""
+
+    data = load(self.m_snapshot_file)
+    self.m_client_groups = tuple(data['client_groups'])
+    self.m_groups = tuple(data['groups'])
+    self.m_purposes = tuple(data['purposes'])
+
+    self.m_clients = sorted((ClientRecord(*c) for c in data['clients']), key=lambda c: c.id)
+    self.m_client_dict = dict((c.id, c) for c in self.m_clients)
+    self.m_files = dict((f[0], FileRecord(*f)) for f in data['files'])
+    self.m_paths = dict((f.path, f) for f in self.m_files.values())
+
+    self.m_protocols = [ProtocolRecord(*p) for p in data['protocols']]
+    protocols = dict((p.id, p) for p in self.m_protocols)
+    self.m_protocol_purposes = [ProtocolPurposeRecord(pu[0], protocols[pu[1]], pu[2], pu[3])
+                                for pu in data['protocol_purposes']]
+    purposes = dict((pu.id, pu) for pu in self.m_protocol_purposes)
+    self.m_memberships = [(purposes[pu_id], file_id) for pu_id, file_id in data['memberships']]
+
+    # keeps the first annotation of each file, as (re_y, re_x, le_y, le_x)
+    self.m_annotations = {}
+    for a in data['annotations']:
+      self.m_annotations.setdefault(a[0], tuple(a[1:]))
+
+    self.m_index = ProtocolIndex(
+        self.m_files.values(), [(c.id, c.sgroup) for c in self.m_clients],
+        [p.name for p in self.m_protocols],
+        [(pu.protocol.name, pu.sgroup, pu.purpose, file_id) for pu, file_id in self.m_memberships])
+
+  def is_valid(self):
+    """Returns if a valid snapshot has been loaded"""
+
+    return self.m_index is not None
+
+  def assert_validity(self):
+    """Raise an IOError if the snapshot has not been loaded"""
+
+    if not self.is_valid():
+      raise IOError("Database of type 'snapshot' cannot be found at expected location '%s'." % self.m_snapshot_file)
+
+  def check_parameters_for_validity(self, parameters, parameter_description, valid_parameters):
+    """Checks the given parameters for validity, see :py:meth:`bob.db.base.Database.check_parameters_for_validity`"""
+
+    return _check_parameters(parameters, parameter_description, valid_parameters)
+
+  def groups(self, protocol=None):
+    """Returns the names of all registered groups"""
+
+    self.assert_validity()
+    return self.m_groups
+
+  def client_groups(self):
+    """Returns the names of the XM2VTS groups"""
+
+    self.assert_validity()
+    return self.m_client_groups
+
+  def purposes(self):
+    """Returns the list of allowed purposes"""
+
+    self.assert_validity()
+    return self.m_purposes
+
+  def clients(self, protocol=None, groups=None, load=None):
+    """Returns a list of :py:class:`.ClientRecord` for the specific query by
+    the user, see :py:meth:`bob.db.xm2vts.Database.clients`. The ``load``
+    parameter is accepted for compatibility and ignored, since the records
+    are plain data."""
+
+    self.assert_validity()
+    if groups:
+      if isinstance(groups, six.string_types):
+        groups = (groups,)
+      groups = set('client' if g in ('dev', 'eval', 'world') else g for g in groups)
+      groups = self.check_parameters_for_validity(groups, "group", self.client_groups())
+      return [c for c in self.m_clients if c.sgroup in groups]
+    return list(self.m_clients)
+
+  def models(self, protocol=None, groups=None):
+    """Returns a list of :py:class:`.ClientRecord` for the specific query by
+    the user, see :py:meth:`bob.db.xm2vts.Database.models`"""
+
+    return self.clients(protocol, groups)
+
+  def model_ids(self, protocol=None, groups=None):
+    """Returns a list of model ids for the specific query by the user, see
+    :py:meth:`bob.db.xm2vts.Database.model_ids`"""
+
+    return [client.id for client in self.clients(protocol, groups)]
+
+  def has_client_id(self, id):
+    """Returns True if we have a client with a certain integer identifier"""
+
+    self.assert_validity()
+    return id in self.m_client_dict
+
+  def client(self, id):
+    """Returns the client object in the database given a certain id. Raises
+    an error if that does not exist."""
+
+    self.assert_validity()
+    if id not in self.m_client_dict:
+      raise ValueError("Client '%s' does not exist" % (id,))
+    return self.m_client_dict[id]
+
+  def objects(self, protocol=None, purposes=None, model_ids=None, groups=None, classes=None,
+              load=None, shard=None, shard_by='file'):
+    """Returns a list of :py:class:`.FileRecord` for the specific query by the
+    user, see :py:meth:`bob.db.xm2vts.Database.objects`. The ``load``
+    parameter is accepted for compatibility and ignored, since the records
+    are plain data."""
+
+    return list(self.iter_objects(protocol, purposes, model_ids, groups, classes, load, shard, shard_by))
+
+  def iter_objects(self, protocol=None, purposes=None, model_ids=None, groups=None, classes=None,
+                   load=None, shard=None, shard_by='file'):
+    """Iterates over the :py:class:`.FileRecord` objects for the specific
+    query by the user, see :py:meth:`bob.db.xm2vts.Database.iter_objects`"""
+
+    self.assert_validity()
+    protocol = self.check_parameters_for_validity(protocol, "protocol", self.protocol_names())
+    purposes = self.check_parameters_for_validity(purposes, "purpose", self.purposes())
+    groups = self.check_parameters_for_validity(groups, "group", self.groups())
+    classes = self.check_parameters_for_validity(classes, "class", ('client', 'impostor'))
+    shard = check_shard(shard, shard_by)
+    if model_ids is None:
+      model_ids = ()
+    elif isinstance(model_ids, six.string_types) or not hasattr(model_ids, '__iter__'):
+      model_ids = (model_ids,)
+
+    ids = self.m_index.select(protocol, purposes, tuple(model_ids), groups, classes)
+    if shard is not None and shard_by == 'client':
+      clients = shard_clients(self.m_clients, shard, purposes, groups, classes)
+      ids = [i for i in ids if self.m_index.client_id(i) in clients]
+    elif shard is not None:
+      ids = [i for i in ids if i % shard[1] == shard[0]]
+    return (self.m_files[i] for i in ids)
+
+  def probe_matrix(self, protocol, group='dev'):
+    """Returns the probe files of the given protocol and group, together with
+    the labels of all model/probe pairs, see
+    :py:meth:`bob.db.xm2vts.Database.probe_matrix`"""
+
+    import numpy
+    if group not in ('dev', 'eval'):
+      raise ValueError("Invalid group '%s'. Valid values are 'dev' or 'eval'" % (group,))
+    probes = self.objects(protocol=protocol, groups=group, purposes='probe')
+    model_ids = self.model_ids(protocol, group)
+    mask = numpy.equal.outer(numpy.array(model_ids, dtype=numpy.int64),
+                             numpy.array([f.client_id for f in probes], dtype=numpy.int64))
+    return model_ids, probes, mask
+
+  def trial_list(self, protocol, group='dev'):
+    """Returns all (model, probe) pairs which are compared in the given
+    protocol and group, see :py:meth:`bob.db.xm2vts.Database.trial_list`. The
+    trials are only cached in memory."""
+
+    self.assert_validity()
+    if not self.has_protocol(protocol):
+      raise ValueError("Invalid protocol '%s'. Valid values are %s" % (protocol, self.protocol_names()))
+    if group not in ('dev', 'eval'):
+      raise ValueError("Invalid group '%s'. Valid values are 'dev' or 'eval'" % (group,))
+    if (protocol, group) not in self.m_trials:
+      model_ids, probes, mask = self.probe_matrix(protocol, group)
+      self.m_trials[(protocol, group)] = make_trials(model_ids, [f.id for f in probes], mask)
+    return self.m_trials[(protocol, group)]
+
+  def files_table(self):
+    """Returns all files of the database as a structured array, see
+    :py:meth:`bob.db.xm2vts.Database.files_table`"""
+
+    import numpy
+    self.assert_validity()
+    purpose_ids = [pu.id for pu in self.m_protocol_purposes]
+    if len(purpose_ids) > 64:
+      raise ValueError("Too many protocol purposes (%d) for a 64 bit mask" % len(purpose_ids))
+    bits = dict((pu_id, numpy.uint64(1) << numpy.uint64(k)) for k, pu_id in enumerate(purpose_ids))
+    client_groups = self.client_groups()
+
+    files = [self.m_files[i] for i in sorted(self.m_files)]
+    path_length = max([len(f.path) for f in files] or [1])
+    table = numpy.zeros(len(files), dtype=[
+        ('id', numpy.int32), ('client_id', numpy.int32), ('session_id', numpy.int8),
+        ('shot_id', numpy.int8), ('darkened', 'U1'), ('client_group', numpy.int8),
+        ('path', 'U%d' % path_length), ('purposes', numpy.uint64)])
+    for i, f in enumerate(files):
+      table[i] = (f.id, f.client_id, f.session_id, f.shot_id, f.darkened,
+                  client_groups.index(self.m_client_dict[f.client_id].sgroup), f.path, 0)
+
+    # sets the bits of the protocol purposes
+    rows = dict((f.id, i) for i, f in enumerate(files))
+    for pu, file_id in self.m_memberships:
+      table['purposes'][rows[file_id]] |= bits[pu.id]
+    return table
+
+  def _cohort(self, protocol, group):
+    """Returns the T-Norm and Z-Norm cohort of the given protocol and group as
+    a tuple ``(model_ids, t_files, z_files)``, see
+    :py:meth:`bob.db.xm2vts.Database.tobjects`"""
+
+    key = (protocol, group)
+    if key not in self.m_cohorts:
+      model_ids = self.model_ids(groups=COHORT_GROUPS[group])
+      cohort = set(model_ids)
+      shots = set((f.session_id, f.darkened, f.shot_id) for f in
+          self.iter_objects(protocol=protocol, groups=group, purposes='enroll'))
+      t_files = sorted((f for f in self.m_files.values() if f.client_id in cohort and
+                        (f.session_id, f.darkened, f.shot_id) in shots),
+                       key=lambda f: (f.client_id, f.session_id, f.darkened, f.shot_id))
+      z_files = [f for f in self.iter_objects(protocol=protocol, groups=group, purposes='probe', classes='impostor')
+                 if f.client_id in cohort]
+      self.m_cohorts[key] = (model_ids, t_files, z_files)
+    return self.m_cohorts[key]
+
+  def _cohorts(self, protocol, groups):
+    """Validates the parameters of the T-Norm and Z-Norm queries and returns
+    the cohorts of all selected protocols and groups"""
+
+    self.assert_validity()
+    protocol = self.check_parameters_for_validity(protocol, "protocol", self.protocol_names())
+    groups = self.check_parameters_for_validity(groups, "group", ('dev', 'eval'))
+    return [self._cohort(p, g) for p in protocol for g in groups]
+
+  def _of_models(self, files, model_ids):
+    """Returns the given files, restricted to the clients in model_ids (if given)"""
+
+    if model_ids is None:
+      return files
+    if isinstance(model_ids, six.string_types) or not hasattr(model_ids, '__iter__'):
+      model_ids = (model_ids,)
+    model_ids = set(model_ids)
+    return [f for f in files if f.client_id in model_ids]
+
+  def tmodel_ids(self, protocol=None, groups=None):
+    """Returns the ids of the T-Norm models, see
+    :py:meth:`bob.db.xm2vts.Database.tmodel_ids`"""
+
+    return sorted(set(i for cohort in self._cohorts(protocol, groups) for i in cohort[0]))
+
+  def tobjects(self, protocol=None, model_ids=None, groups=None):
+    """Returns the enrollment files of the T-Norm models, see
+    :py:meth:`bob.db.xm2vts.Database.tobjects`"""
+
+    return self._of_models([f for cohort in self._cohorts(protocol, groups) for f in cohort[1]], model_ids)
+
+  def zobjects(self, protocol=None, model_ids=None, groups=None):
+    """Returns the Z-Norm probe files, see
+    :py:meth:`bob.db.xm2vts.Database.zobjects`"""
+
+    return self._of_models([f for cohort in self._cohorts(protocol, groups) for f in cohort[2]], model_ids)
+
+  def t_model_ids(self, protocol, groups='dev', **kwargs):
+    """Returns the list of model ids used for T-Norm of the given protocol for the given group"""
+    return self.tmodel_ids(protocol=protocol, groups=groups, **kwargs)
+
+  def t_enroll_files(self, protocol, model_id, groups='dev', **kwargs):
+    """Returns the list of T-Norm model enrollment files of the given model id of the given protocol for the given group"""
+    return self.uniquify(self.tobjects(protocol=protocol, groups=groups, model_ids=(model_id,), **kwargs))
+
+  def z_probe_files(self, protocol, groups='dev', **kwargs):
+    """Returns the list of Z-Norm probe files of the given protocol for the given group"""
+    return self.uniquify(self.zobjects(protocol=protocol, groups=groups, **kwargs))
+
+  def annotations(self, file):
+    """Returns the annotations for the given file as a dictionary
+    {'reye':(y,x), 'leye':(y,x)}, or ``None`` if the file is not annotated."""
+
+    self.assert_validity()
+    a = self.m_annotations.get(file.id)
+    if a is None:
+      return None
+    return {'reye': (a[0], a[1]), 'leye': (a[2], a[3])}
+
+  def annotations_bulk(self, files):
+    """Returns the annotations for a list of files, see
+    :py:meth:`bob.db.xm2vts.Database.annotations_bulk`"""
+
+    import numpy
+    self.assert_validity()
+    ids = [getattr(f, 'id', f) for f in files]
+    annotations = numpy.zeros((len(ids), 4), dtype=numpy.int32)
+    missing = numpy.ones(len(ids), dtype=bool)
+    for i, file_id in enumerate(ids):
+      if file_id in self.m_annotations:
+        annotations[i] = self.m_annotations[file_id]
+        missing[i] = False
+    return annotations, missing
+
+  def protocol_names(self):
+    """Returns all registered protocol names"""
+
+    self.assert_validity()
+    return [p.name for p in self.m_protocols]
+
+  def protocols(self):
+    """Returns all registered protocols"""
+
+    self.assert_validity()
+    return list(self.m_protocols)
+
+  def has_protocol(self, name):
+    """Tells if a certain protocol is available"""
+
+    return name in self.protocol_names()
+
+  def protocol(self, name):
+    """Returns the protocol object in the database given a certain name. Raises
+    an error if that does not exist."""
+
+    for p in self.protocols():
+      if p.name == name:
+        return p
+    raise ValueError("Protocol '%s' does not exist" % (name,))
+
+  def protocol_purposes(self):
+    """Returns all registered protocol purposes, ordered by their id"""
+
+    self.assert_validity()
+    return list(self.m_protocol_purposes)
+
+  def files(self, ids, preserve_order=True):
+    """Returns a list of :py:class:`.FileRecord` objects for the given ids;
+    unknown ids are omitted"""
+
+    self.assert_validity()
+    return [self.m_files[i] for i in ids if i in self.m_files]
+
+  def paths(self, ids, prefix=None, suffix=None, preserve_order=True):
+    """Returns a full file paths considering particular file ids"""
+
+    return [f.make_path(prefix, suffix) for f in self.files(ids, preserve_order)]
+
+  def reverse(self, paths, preserve_order=True):
+    """Returns a list of :py:class:`.FileRecord` objects for the given path
+    stems; unknown paths are omitted"""
+
+    self.assert_validity()
+    return [self.m_paths[p] for p in paths if p in self.m_paths]
+
+  def reverse_bulk(self, paths):
+    """Translates many path stems into file ids at once, see
+    :py:meth:`bob.db.xm2vts.Database.reverse_bulk`"""
+
+    import numpy
+    self.assert_validity()
+    return numpy.array([self.m_paths[p].id if p in self.m_paths else -1 for p in (str(p) for p in paths)],
+                       dtype=numpy.int64)
+
+  def paths_bulk(self, ids, prefix='', suffix=''):
+    """Translates many file ids into paths at once, see
+    :py:meth:`bob.db.xm2vts.Database.paths_bulk`"""
+
+    import numpy
+    self.assert_validity()
+    ids = [int(i) for i in ids]
+    retval = numpy.empty(len(ids), dtype=object)
+    retval[:] = [os.path.join(prefix, self.m_files[i].path + suffix) if i in self.m_files else None for i in ids]
+    return retval
+
+  def uniquify(self, file_list):
+    """Sorts the given list of files by id and removes duplicates"""
+
+    return sorted(set(file_list), key=lambda f: f.id)
+
+  def original_file_name(self, file, check_existence=True):
+    """Returns the full path of the original data of the given file"""
+
+    if self.original_directory is None:
+      raise ValueError("Please specify the original_directory in the constructor of this class")
+    original_file_name = file.make_path(self.original_directory, self.original_extension)
+    if check_existence and not os.path.exists(original_file_name):
+      raise IOError("The original file '%s' was not found" % original_file_name)
+    return original_file_name
+
+  def original_file_names(self, files, check_existence=True):
+    """Returns the full paths of the original data of the given files"""
+
+    return [self.original_file_name(f, check_existence) for f in files]
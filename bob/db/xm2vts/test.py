@@ -20,6 +20,8 @@
 """
 
 import os, sys
+import contextlib
+import numpy
 import bob.db.xm2vts
 
 
@@ -40,6 +42,63 @@ def db_available(test):
   return wrapper
 
 
+def synthetic_tree(root, clients=(3, 4, 0, 1)):
+  """Creates empty images and annotation files of the given clients, following
+  the directory structure of the XM2VTS database"""
+  images, annotations = os.path.join(root, 'images'), os.path.join(root, 'annotations')
+  for c in clients:
+    for subdir, names in (('frontal', ['%03d_%d_%d' % (c, s, sh) for s in (1, 2, 3, 4) for sh in (1, 2)]),
+                          ('darkened', ['%03d_4_%s%d' % (c, d, sh) for d in 'lr' for sh in (1, 2)])):
+      os.makedirs(os.path.join(images, subdir, '%03d' % c))
+      os.makedirs(os.path.join(annotations, subdir, '%03d' % c))
+      for name in names:
+        open(os.path.join(images, subdir, '%03d' % c, name + '.ppm'), 'w').close()
+        with open(os.path.join(annotations, subdir, '%03d' % c, name + '.pos'), 'w') as f:
+          f.write('%d 120 %d 121\n' % (100 + c, 160 + c))
+  return images, annotations
+
+
+def create_synthetic(root, **kwargs):
+  """Creates the SQL database of the synthetic tree in the given directory and
+  returns the name of the database file"""
+  import argparse
+  from bob.db.xm2vts.create import create
+  images, annotations = os.path.join(root, 'images'), os.path.join(root, 'annotations')
+  dbfile = os.path.join(root, 'db', 'db.sql3')
+  options = dict(type='sqlite', files=[dbfile], recreate=True, verbose=0, imagedir=images,
+                 annotdir=annotations, annotsub=None, jobs=1)
+  options.update(kwargs)
+  create(argparse.Namespace(**options))
+  return dbfile
+
+
+def table_rows(dbfile, statement):
+  """Returns the rows of the given SQL statement on the given database file"""
+  import sqlite3
+  connection = sqlite3.connect(dbfile)
+  try:
+    return connection.execute(statement).fetchall()
+  finally:
+    connection.close()
+
+
+@contextlib.contextmanager
+def count_statements(db):
+  """Collects the SQL statements issued through the session of the given database"""
+  from sqlalchemy import event
+  engine = db.m_session.get_bind()
+  statements = []
+
+  def _collect(conn, cursor, statement, parameters, context, executemany):
+    statements.append(statement)
+
+  event.listen(engine, 'before_cursor_execute', _collect)
+  try:
+    yield statements
+  finally:
+    event.remove(engine, 'before_cursor_execute', _collect)
+
+
 @db_available
 def test_clients():
   db = bob.db.xm2vts.Database()
@@ -185,3 +244,763 @@ def test_driver_api():
   assert main('xm2vts reverse frontal/342/342_2_1 --self-test'.split()) == 0
   assert main('xm2vts path 3011 --self-test'.split()) == 0
 
+
+
+@db_available
+def test_driver_startup():
+  # Tests that building the command line and parsing the arguments of every
+  # subcommand does not open the database
+  import subprocess, tempfile, shutil
+  from bob.db.base.script.dbmanage import main
+  commands = ['create', 'update --schema-only', 'snapshot', 'dumplist --protocol=lp1', 'checkfiles -j 4',
+              'reverse frontal/342/342_2_1', 'path 3011']
+  code = "import sys, argparse; from bob.db.xm2vts.driver import Interface; " \
+         "parser = argparse.ArgumentParser(); Interface().add_commands(parser.add_subparsers()); " \
+         "[parser.parse_args(['xm2vts'] + c.split()) for c in %r]; " \
+         "print('bob.db.xm2vts.query' in sys.modules)" % (commands,)
+  loaded = subprocess.check_output([sys.executable, '-c', code]).decode()
+  assert loaded.strip() == 'False'
+
+  # create and update would overwrite the installed database and are run on
+  # a synthetic tree by the other tests
+  root = tempfile.mkdtemp(prefix='bobtest_')
+  try:
+    for command in ('snapshot -o %s' % os.path.join(root, 'db.snapshot'), 'dumplist --self-test',
+                    'dumplist --protocol=lp1 --client=10 --self-test', 'checkfiles --self-test',
+                    'reverse frontal/342/342_2_1 --self-test', 'path 3011 --self-test'):
+      assert main(('xm2vts ' + command).split()) == 0
+  finally:
+    shutil.rmtree(root)
+
+  # the choices read from the database are checked when the command is run
+  assert main('xm2vts dumplist --protocol=lp3 --self-test'.split()) == 2
+  assert main('xm2vts dumplist --client=999999 --self-test'.split()) == 2
+
+
+@db_available
+def test_dumplist_formats():
+  # Tests the different output formats of dumplist against objects()
+  import io, json
+  from bob.db.base.script.dbmanage import main
+  files = bob.db.xm2vts.Database().objects(protocol='lp1', groups='dev')
+  outputs = {}
+  for format in ('newline', 'nul', 'jsonl'):
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+      assert main(('xm2vts dumplist --protocol=lp1 --group=dev -d /data -e .ppm --format=%s' % format).split()) == 0
+    outputs[format] = output.getvalue()
+
+  paths = [f.make_path('/data', '.ppm') for f in files]
+  assert outputs['newline'] == ''.join(p + '\n' for p in paths)
+  assert outputs['nul'] == ''.join(p + '\0' for p in paths)
+  entries = [json.loads(l) for l in outputs['jsonl'].splitlines()]
+  assert entries == [{'id': f.id, 'path': p, 'client_id': f.client_id} for f, p in zip(files, paths)]
+
+
+@db_available
+def test_checkfiles():
+  # Tests the parallel check of the files against a directory with a missing
+  # and an empty file
+  import io, tempfile, shutil
+  from bob.db.base.script.dbmanage import main
+  files = bob.db.xm2vts.Database().objects()
+  root = tempfile.mkdtemp(prefix='bobtest_')
+  try:
+    for f in files:
+      path = f.make_path(root, '.ppm')
+      if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+      with open(path, 'w') as fh:
+        fh.write('' if f is files[1] else 'P6')
+    os.remove(files[0].make_path(root, '.ppm'))
+
+    for options, missing in (('-j 1', 1), ('-j 8', 1), ('-j 8 --verify', 2)):
+      output = io.StringIO()
+      with contextlib.redirect_stdout(output):
+        assert main(('xm2vts checkfiles -d %s -e .ppm %s' % (root, options)).split()) == 0
+      lines = output.getvalue().splitlines()
+      assert lines[-1].startswith('Checked %d files' % len(files))
+      assert lines[-2].startswith('%d files (out of %d) were not found' % (missing, len(files)))
+      assert 'Cannot find file "%s"' % files[0].make_path(root, '.ppm') in lines
+
+  finally:
+    shutil.rmtree(root)
+
+
+@db_available
+def test_bulk_lookups():
+  # Compares the bulk translations between paths and ids with the ones of a
+  # file at a time
+  import io
+  from bob.db.base.script.dbmanage import main
+  db = bob.db.xm2vts.Database()
+  files = db.objects()
+  stems = [f.path for f in files] + ['unknown/path']
+  ids = numpy.array([f.id for f in files] + [999999])
+
+  single = [db.reverse([s])[0].id if db.reverse([s]) else -1 for s in stems[:200]]
+  bulk = db.reverse_bulk(stems)
+  assert bulk.dtype == numpy.int64
+  assert list(bulk[:200]) == single
+  assert list(bulk) == list(ids[:-1]) + [-1]
+
+  paths = db.paths_bulk(ids, prefix='/data', suffix='.ppm')
+  assert list(paths[:-1]) == db.paths([f.id for f in files], prefix='/data', suffix='.ppm')
+  assert paths[-1] is None
+  assert list(db.paths_bulk(ids[::-1])[1:]) == stems[-2::-1]
+
+  # the command line reads the stems and ids from the standard input
+  stdin = sys.stdin
+  try:
+    for command, data, expected in (('reverse -', '\n'.join(stems), ''.join('%d\n' % i for i in ids[:-1])),
+                                    ('path -', ' '.join(str(i) for i in ids), ''.join(s + '\n' for s in stems[:-1]))):
+      sys.stdin = io.StringIO(data)
+      output = io.StringIO()
+      with contextlib.redirect_stdout(output):
+        assert main(('xm2vts ' + command).split()) == 0
+      assert output.getvalue() == expected
+  finally:
+    sys.stdin = stdin
+
+  # '-' is only accepted as the only value
+  for command in ('reverse frontal/342/342_2_1 -', 'path 1 - 2'):
+    with contextlib.redirect_stderr(io.StringIO()):
+      assert main(('xm2vts ' + command).split()) == 2
+
+
+@db_available
+def test_score_normalization():
+  # Tests the T-Norm and Z-Norm cohorts, which are computed once per protocol
+  db = bob.db.xm2vts.Database()
+  for protocol in db.protocol_names():
+    for group, cohort_group, other_group in (('dev', 'impostorDev', 'impostorEval'), ('eval', 'impostorEval', 'impostorDev')):
+      tmodel_ids = db.t_model_ids(protocol, groups=group)
+      assert tmodel_ids == db.model_ids(groups=cohort_group)
+      # the cohort is disjoint from the models and from the other set
+      assert not set(tmodel_ids) & set(db.model_ids(groups=(group, other_group)))
+
+      # the T-Norm models are enrolled like the models of the protocol
+      enroll = db.objects(protocol=protocol, groups=group, purposes='enroll', model_ids=db.model_ids(groups=group)[0])
+      for model_id in tmodel_ids:
+        files = db.t_enroll_files(protocol, model_id, groups=group)
+        assert sorted((f.session_id, f.darkened, f.shot_id) for f in files) == \
+            sorted((f.session_id, f.darkened, f.shot_id) for f in enroll)
+        assert set(f.client_id for f in files) == set([model_id])
+
+      zfiles = db.z_probe_files(protocol, groups=group)
+      assert zfiles
+      assert set(f.client_id for f in zfiles) == set(tmodel_ids)
+      assert set(zfiles) <= set(db.objects(protocol=protocol, groups=group, purposes='probe', classes='impostor'))
+
+  # the cohorts are cached
+  with count_statements(db) as statements:
+    for model_id in db.t_model_ids('lp1'):
+      db.t_enroll_files('lp1', model_id)
+      db.z_probe_files('lp1')
+  assert len(statements) == 0
+
+  db.clear_cache()
+  with count_statements(db) as statements:
+    db.tobjects('lp1', groups='dev')
+  assert len(statements) > 0
+
+
+def test_trial_list():
+  # Tests the trials against the probe matrix, and their cache on disk
+  import tempfile, shutil
+  from bob.db.base.utils import session_try_readonly
+  root = tempfile.mkdtemp(prefix='bobtest_')
+  try:
+    synthetic_tree(root)
+    dbfile = create_synthetic(root)
+
+    def _database():
+      # a database object on the synthetic database
+      db = bob.db.xm2vts.Database()
+      db.m_sqlite_file = dbfile
+      db.m_session = session_try_readonly('sqlite', dbfile)
+      return db
+
+    db = _database()
+    model_ids, probes, mask = db.probe_matrix('lp1', 'dev')
+    m, p, trials = db.trial_list('lp1', 'dev')
+    assert list(m) == model_ids
+    assert list(p) == [f.id for f in probes]
+    assert len(trials) == mask.size > 0
+    assert (trials['is_genuine'] == mask[trials['model_index'], trials['probe_index']]).all()
+    assert (trials['model_index'] * len(p) + trials['probe_index'] == numpy.arange(len(trials))).all()
+    # only the cache is left in the directory of the database
+    assert sorted(os.listdir(os.path.dirname(dbfile))) == ['db.snapshot', 'db.sql3', 'trials-lp1-dev.npz']
+
+    # a new Database object reads the trials from disk, unless the database was modified
+    stat = os.stat(dbfile)
+    for mtime, queries in ((stat.st_mtime_ns, 0), (stat.st_mtime_ns + 10**9, 1)):
+      os.utime(dbfile, ns=(stat.st_atime_ns, mtime))
+      db = _database()
+      with count_statements(db) as statements:
+        m2, p2, trials2 = db.trial_list('lp1', 'dev')
+      assert (len([s for s in statements if 'FROM file' in s]) > 0) == bool(queries)
+      assert (m2 == m).all() and (p2 == p).all() and (trials2 == trials).all()
+  finally:
+    shutil.rmtree(root)
+
+
+@db_available
+def test_shards():
+  # Tests that the shards are a balanced partition of the files
+  import io
+  from bob.db.base.script.dbmanage import main
+  n = 7
+  for kwargs in ({}, {'use_index': True}, {'lightweight': True}):
+    db = bob.db.xm2vts.Database(**kwargs)
+    # the world group only contains the files of the clients of the 'client' group
+    for query in ({'protocol': 'lp1'}, {'protocol': 'lp1', 'groups': 'world'}):
+      files = db.objects(**query)
+      for shard_by in ('file', 'client'):
+        shards = [db.objects(shard=(k, n), shard_by=shard_by, **query) for k in range(n)]
+        assert sorted(f.id for shard in shards for f in shard) == sorted(f.id for f in files)
+        assert [f.id for f in files if f in set(shards[2])] == [f.id for f in shards[2]]
+        if shard_by == 'file':
+          assert max(len(shard) for shard in shards) - min(len(shard) for shard in shards) <= len(files) // n // 10 + 1
+        else:
+          clients = [set(f.client_id for f in shard) for shard in shards]
+          assert sum(len(c) for c in clients) == len(set.union(*clients))
+          # the shards have the same number of clients up to one
+          assert max(len(c) for c in clients) - min(len(c) for c in clients) <= 1
+          per_client = {}
+          for f in files:
+            per_client[f.client_id] = per_client.get(f.client_id, 0) + 1
+          assert max(len(shard) for shard in shards) - min(len(shard) for shard in shards) <= max(per_client.values())
+
+  db = bob.db.xm2vts.Database()
+  for shard in ((2, 2), (-1, 2), (0, 0)):
+    try:
+      db.objects(shard=shard)
+      assert False, "shard %s should have raised" % (shard,)
+    except ValueError:
+      pass
+
+  # the command line dumps the same shards
+  output = io.StringIO()
+  with contextlib.redirect_stdout(output):
+    assert main('xm2vts dumplist --protocol=lp1 --shard 3/7 --shard-by client'.split()) == 0
+  assert output.getvalue().splitlines() == [f.path for f in db.objects(protocol='lp1', shard=(3, 7), shard_by='client')]
+
+
+@db_available
+def test_index():
+  # Tests that the in-memory index returns exactly the same files as the SQL queries
+  db = bob.db.xm2vts.Database()
+  idb = bob.db.xm2vts.Database(use_index=True)
+
+  queries = [{}]
+  for protocol in db.protocol_names():
+    queries.append({'protocol': protocol})
+    queries.append({'protocol': protocol, 'groups': 'world'})
+    queries.append({'protocol': protocol, 'groups': 'world', 'model_ids': [3]})
+    for group in ('dev', 'eval', ('dev', 'eval')):
+      queries.append({'protocol': protocol, 'groups': group, 'purposes': 'enroll', 'model_ids': [3, 4]})
+      for classes in (None, 'client', 'impostor'):
+        for model_ids in (None, [3], [3, 4]):
+          queries.append({'protocol': protocol, 'groups': group, 'purposes': 'probe', 'classes': classes, 'model_ids': model_ids})
+
+  for query in queries:
+    expected = sorted(f.id for f in db.objects(**query))
+    assert sorted(f.id for f in idb.objects(**query)) == expected, query
+
+
+@db_available
+def test_probe_matrix():
+  # Tests that the probe matrix is consistent with the per-model queries
+  db = bob.db.xm2vts.Database()
+
+  for protocol, group in (('lp1', 'dev'), ('darkened-lp2', 'eval')):
+    model_ids, probes, mask = db.probe_matrix(protocol, group)
+    assert len(model_ids) == 200
+    assert mask.shape == (len(model_ids), len(probes))
+    assert mask.dtype == bool
+    for i in (0, 17, 199):
+      objects = db.objects(protocol=protocol, groups=group, purposes='probe', model_ids=[model_ids[i]])
+      clients = db.objects(protocol=protocol, groups=group, purposes='probe', model_ids=[model_ids[i]], classes='client')
+      assert set(f.id for f in objects) == set(f.id for f in probes)
+      assert set(f.id for f in clients) == set(f.id for f, m in zip(probes, mask[i]) if m)
+
+
+@db_available
+def test_iter_objects():
+  # Tests that the streamed files are unique, stable and identical to objects()
+  db = bob.db.xm2vts.Database()
+
+  for kwargs in ({}, {'protocol': 'lp1', 'groups': 'dev', 'purposes': 'probe', 'model_ids': [3]}):
+    files = [f.id for f in db.iter_objects(**kwargs)]
+    assert len(files) == len(set(files))
+    assert files == [f.id for f in db.objects(**kwargs)]
+    assert files == [f.id for f in bob.db.xm2vts.Database().iter_objects(**kwargs)]
+
+  # the first file is available without reading the others
+  assert next(db.iter_objects(protocol='lp1', groups='world')).client_id == 3
+
+
+@db_available
+def test_objects_single_query():
+  # Tests that a request of objects() is answered by a single query, which
+  # returns the union of the files of its parts
+  db = bob.db.xm2vts.Database()
+  parts = [
+      {'groups': 'world'},
+      {'groups': ('dev', 'eval'), 'purposes': 'enroll'},
+      {'groups': ('dev', 'eval'), 'purposes': 'probe', 'classes': 'client'},
+      {'groups': ('dev', 'eval'), 'purposes': 'probe', 'classes': 'impostor'},
+  ]
+  separate = set()
+  for kwargs in parts:
+    separate.update(f.id for f in db.objects(protocol='lp1', model_ids=[3], **kwargs))
+
+  with count_statements(db) as statements:
+    combined = [f.id for f in db.objects(protocol='lp1', model_ids=[3])]
+  assert len([s for s in statements if 'FROM file' in s]) == 1
+  assert set(combined) == separate
+  assert len(combined) == len(separate)
+
+
+@db_available
+def test_client_cache():
+  # Tests that the client table is read once and served from memory afterwards
+  from sqlalchemy.orm.exc import NoResultFound
+  db = bob.db.xm2vts.Database()
+  with count_statements(db) as statements:
+    assert len(db.clients()) == 295
+    first = len(statements)
+    for _ in range(100):
+      assert len(db.models(groups='dev')) == 200
+      assert len(db.model_ids(groups=('impostorDev', 'impostorEval'))) == 95
+      assert db.has_client_id(3)
+      assert not db.has_client_id(999999)
+      assert db.client(3).sgroup == 'client'
+  assert first == 1
+  assert len(statements) == first
+  assert db.model_ids(groups='client') == sorted(db.model_ids(groups='client'))
+  assert db.model_ids() == [c.id for c in db.clients()]
+  try:
+    db.client(999999)
+    assert False, "client(999999) should have raised"
+  except NoResultFound:
+    pass
+
+  # the cache is read again after it has been cleared
+  db.clear_cache()
+  with count_statements(db) as statements:
+    db.model_ids()
+  assert len(statements) == 1
+
+
+@db_available
+def test_protocol_cache():
+  # Tests that the protocol catalogue is read once and reused for validation
+  from sqlalchemy.orm.exc import NoResultFound
+  db = bob.db.xm2vts.Database()
+  db.objects(protocol='lp1', groups='world')
+  with count_statements(db) as statements:
+    for _ in range(10):
+      db.objects(protocol='lp1', groups='dev', purposes='enroll')
+      assert db.has_protocol('lp2')
+      assert not db.has_protocol('lp3')
+      assert db.protocol('darkened-lp1').name == 'darkened-lp1'
+      assert len(db.protocols()) == len(db.protocol_names())
+  # only the queries of the files are issued
+  assert len(statements) == 10
+  try:
+    db.protocol('lp3')
+    assert False, "protocol('lp3') should have raised"
+  except NoResultFound:
+    pass
+
+  db.clear_cache()
+  with count_statements(db) as statements:
+    db.protocol_names()
+  assert len(statements) == 2
+
+
+@db_available
+def test_files_table():
+  # Tests that vectorized selections over the files table match objects()
+  db = bob.db.xm2vts.Database()
+  table = db.files_table()
+  assert len(table) == 3440
+  assert list(table['id']) == sorted(f.id for f in db.objects())
+
+  purposes = db.protocol_purposes()
+  for k, pu in enumerate(purposes):
+    members = table['id'][(table['purposes'] & numpy.uint64(1 << k)) != 0]
+    assert set(members) == set(f.id for f in pu.files)
+
+  # all world files of lp1 belong to clients
+  world = [k for k, pu in enumerate(purposes) if pu.protocol.name == 'lp1' and pu.sgroup == 'world'][0]
+  selected = table[(table['purposes'] & numpy.uint64(1 << world)) != 0]
+  assert len(selected) == 600
+  assert (selected['client_group'] == db.client_groups().index('client')).all()
+
+
+@db_available
+def test_annotations_bulk():
+  # Tests that the bulk annotations are identical to the ones of single files
+  db = bob.db.xm2vts.Database()
+
+  for files in (db.objects(protocol='lp1', groups='world', model_ids=[3, 4]), db.objects()):
+    with count_statements(db) as statements:
+      annotations, missing = db.annotations_bulk(files)
+    assert len(statements) == 1
+    assert annotations.shape == (len(files), 4)
+    assert not missing.any()
+    for f, a in zip(files[:100], annotations):
+      expected = db.annotations(f)
+      assert tuple(a) == expected['reye'] + expected['leye']
+
+  annotations, missing = db.annotations_bulk([-1])
+  assert missing[0]
+  assert tuple(annotations[0]) == (0, 0, 0, 0)
+
+
+@db_available
+def test_eager_loading():
+  # Tests that the number of SQL statements does not depend on the number of files
+  counts = []
+  for kwargs in ({'protocol': 'lp1', 'groups': 'world', 'model_ids': [3]}, {'protocol': 'lp1'}, {}):
+    db = bob.db.xm2vts.Database()
+    with count_statements(db) as statements:
+      files = db.objects(load=('client', 'annotation'), **kwargs)
+      for f in files:
+        assert f.client.sgroup in db.client_groups()
+        assert len(f.annotation()) == 2
+    counts.append(len(statements))
+  assert len(set(counts)) == 1
+
+  db = bob.db.xm2vts.Database()
+  with count_statements(db) as statements:
+    assert sum(len(c.files) for c in db.clients(load='files')) == 3440
+  assert len(statements) == 1
+
+
+@db_available
+def test_lightweight():
+  # Tests that the lightweight records are equivalent to the ORM objects
+  import tracemalloc
+  # the databases are kept alive, since their session is closed on deletion
+  databases, results = {}, {}
+  for lightweight in (False, True):
+    databases[lightweight] = bob.db.xm2vts.Database(lightweight=lightweight)
+    databases[lightweight].protocol_names()  # opens the connection
+    tracemalloc.start()
+    files = databases[lightweight].objects()
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    results[lightweight] = (files, memory)
+
+  orm, records = results[False][0], results[True][0]
+  assert [f.id for f in orm] == [f.id for f in records]
+  assert [f.make_path('/tmp', '.ppm') for f in orm] == [f.make_path('/tmp', '.ppm') for f in records]
+  assert all(isinstance(f, bob.db.xm2vts.FileRecord) for f in records)
+  assert len(set(records)) == len(records)
+  assert results[True][1] < results[False][1]
+
+  db = databases[True]
+  assert [c.id for c in db.clients(groups='dev')] == [c.id for c in databases[False].clients(groups='dev')]
+  assert all(isinstance(c, bob.db.xm2vts.ClientRecord) for c in db.clients())
+  assert db.reverse(['frontal/342/342_2_1', 'unknown'])[0].path == 'frontal/342/342_2_1'
+  assert len(db.reverse(['frontal/342/342_2_1', 'unknown'])) == 1
+  assert db.annotations(records[0]) == databases[False].annotations(orm[0])
+
+
+@db_available
+def test_snapshot():
+  # Tests that the snapshot database answers the queries like the SQL database
+  import tempfile
+  from bob.db.xm2vts.create import write_snapshot
+  db = bob.db.xm2vts.Database()
+  snapshot_file = os.path.join(tempfile.mkdtemp(prefix='bobtest_'), 'db.snapshot')
+  write_snapshot(db.m_session, snapshot_file, 0)
+  sdb = bob.db.xm2vts.SnapshotDatabase(snapshot_file=snapshot_file)
+  assert sdb.is_valid()
+
+  assert sdb.protocol_names() == db.protocol_names()
+  assert sdb.model_ids(groups='dev') == db.model_ids(groups='dev')
+  assert len(sdb.clients(groups='impostorEval')) == 70
+  for kwargs in ({}, {'protocol': 'lp2', 'groups': 'eval', 'purposes': 'probe', 'model_ids': [3]},
+                 {'protocol': 'darkened-lp1', 'groups': 'world'}):
+    assert sorted(f.id for f in sdb.objects(**kwargs)) == sorted(f.id for f in db.objects(**kwargs))
+
+  f = db.reverse(['frontal/342/342_2_1'])[0]
+  assert sdb.reverse(['frontal/342/342_2_1'])[0].id == f.id
+  assert sdb.paths([f.id], prefix='/tmp', suffix='.ppm') == db.paths([f.id], prefix='/tmp', suffix='.ppm')
+  assert sdb.annotations(sdb.files([f.id])[0]) == db.annotations(f)
+
+  # the snapshot database can be used without loading SQLAlchemy
+  import subprocess
+  code = "import sys, bob.db.xm2vts; db = bob.db.xm2vts.SnapshotDatabase(snapshot_file=%r); " \
+         "assert len(db.objects(protocol='lp1')) == 2360; print('sqlalchemy' in sys.modules)" % snapshot_file
+  assert subprocess.check_output([sys.executable, '-c', code]).decode().strip() == 'False'
+
+  os.unlink(snapshot_file)
+  assert not bob.db.xm2vts.SnapshotDatabase(snapshot_file=snapshot_file).is_valid()
+
+
+@db_available
+def test_snapshot_parity():
+  # Tests that the snapshot database provides the whole API of the SQL database
+  import tempfile, shutil, inspect
+  from bob.db.xm2vts.query import Database
+  from bob.db.xm2vts.create import write_snapshot
+  methods = [n for n, m in vars(Database).items() if not n.startswith('_') and callable(m)]
+  missing = [n for n in methods if not hasattr(bob.db.xm2vts.SnapshotDatabase, n)]
+  assert not missing, missing
+  # the methods accept the same parameters, in the same order
+  different = [n for n in methods if list(inspect.signature(getattr(Database, n)).parameters) !=
+               list(inspect.signature(getattr(bob.db.xm2vts.SnapshotDatabase, n)).parameters)]
+  assert not different, different
+
+  db = bob.db.xm2vts.Database()
+  root = tempfile.mkdtemp(prefix='bobtest_')
+  try:
+    snapshot_file = os.path.join(root, 'db.snapshot')
+    write_snapshot(db.m_session, snapshot_file, 0)
+    sdb = bob.db.xm2vts.SnapshotDatabase(snapshot_file=snapshot_file)
+
+    files = db.objects()
+    stems, ids = [f.path for f in files] + ['unknown'], [f.id for f in files] + [999999]
+    assert (sdb.reverse_bulk(stems) == db.reverse_bulk(stems)).all()
+    assert list(sdb.paths_bulk(ids, '/data', '.ppm')) == list(db.paths_bulk(ids, '/data', '.ppm'))
+    assert (sdb.files_table() == db.files_table()).all()
+    for shard_by in ('file', 'client'):
+      assert [f.id for f in sdb.objects(protocol='lp1', shard=(2, 5), shard_by=shard_by)] == \
+          [f.id for f in db.objects(protocol='lp1', shard=(2, 5), shard_by=shard_by)]
+    for group in ('dev', 'eval'):
+      assert sdb.t_model_ids('lp2', groups=group) == db.t_model_ids('lp2', groups=group)
+      assert [f.id for f in sdb.tobjects('lp2', groups=group)] == [f.id for f in db.tobjects('lp2', groups=group)]
+      assert [f.id for f in sdb.zobjects('lp2', groups=group)] == [f.id for f in db.zobjects('lp2', groups=group)]
+      for s, d in zip(sdb.trial_list('lp1', group), db.trial_list('lp1', group)):
+        assert (s == d).all()
+  finally:
+    shutil.rmtree(root)
+
+
+def test_import_time():
+  # Tests that importing the package does not load the heavy dependencies
+  import subprocess
+  code = "import sys; import bob.db.xm2vts; " \
+         "print(' '.join(m for m in ('sqlalchemy', 'numpy', 'bob.db.base', 'pkg_resources') if m in sys.modules))"
+  loaded = subprocess.check_output([sys.executable, '-c', code]).decode()
+  assert loaded.strip() == '', loaded
+
+  # the classes are still available from the package
+  assert bob.db.xm2vts.Database.__name__ == 'Database'
+  assert 'Database' in bob.db.xm2vts.__all__
+  assert 'Database' in dir(bob.db.xm2vts)
+
+
+def test_create_parallel_scan():
+  # Tests that scanning the image directories in parallel registers the same files
+  import tempfile, shutil
+  root = tempfile.mkdtemp(prefix='bobtest_')
+  try:
+    synthetic_tree(root)
+    files = []
+    for jobs in (1, 4):
+      dbfile = create_synthetic(root, jobs=jobs)
+      files.append(table_rows(dbfile, 'SELECT id, client_id, path, session_id, darkened, shot_id FROM file ORDER BY id'))
+    assert len(files[0]) == 4 * 12
+    assert files[0] == files[1]
+    assert ('frontal/003/003_2_1', 2, 'n', 1) in [f[2:] for f in files[0]]
+    assert ('darkened/001/001_4_r2', 4, 'r', 2) in [f[2:] for f in files[0]]
+  finally:
+    shutil.rmtree(root)
+
+
+def test_create_all_clients():
+  # Creates the database of a synthetic image tree with all clients
+  import tempfile, shutil
+  from bob.db.xm2vts.create import CLIENTS
+  root = tempfile.mkdtemp(prefix='bobtest_')
+  try:
+    clients = [c for group in CLIENTS.values() for c in group]
+    synthetic_tree(root, clients)
+    dbfile = create_synthetic(root)
+
+    assert table_rows(dbfile, 'SELECT COUNT(*) FROM client') == [(295,)]
+    assert table_rows(dbfile, 'SELECT COUNT(*) FROM file') == [(295 * 12,)]
+    assert table_rows(dbfile, 'SELECT COUNT(*) FROM annotation') == [(295 * 12,)]
+    counts = dict(((r[0], r[1], r[2]), r[3]) for r in table_rows(dbfile,
+        'SELECT protocol.name, protocolPurpose.sgroup, protocolPurpose.purpose, COUNT(*) '
+        'FROM protocolPurpose_file_association '
+        'JOIN protocolPurpose ON protocolPurpose.id = protocolPurpose_file_association.protocolPurpose_id '
+        'JOIN protocol ON protocol.id = protocolPurpose.protocol_id '
+        'GROUP BY protocol.name, protocolPurpose.sgroup, protocolPurpose.purpose'))
+    assert counts[('lp1', 'world', 'train')] == 600
+    assert counts[('lp1', 'dev', 'enroll')] == 600
+    assert counts[('lp1', 'dev', 'probe')] == 800
+    assert counts[('lp1', 'eval', 'probe')] == 960
+    assert counts[('lp2', 'dev', 'probe')] == 600
+    assert counts[('darkened-lp1', 'eval', 'probe')] == 1080
+    assert counts[('darkened-lp2', 'eval', 'enroll')] == 800
+  finally:
+    shutil.rmtree(root)
+
+
+def test_protocol_memberships():
+  # Tests the single-pass computation of the protocol memberships
+  from bob.db.xm2vts.create import protocol_memberships
+  purposes = [(1, 'lp1', 'world', 'train'), (2, 'lp1', 'dev', 'probe'), (3, 'darkened-lp1', 'eval', 'probe')]
+  files = [
+    (10, 1, 'n', 1, 'client'),        # lp1 world
+    (11, 1, 'n', 2, 'client'),        # lp1 dev probe
+    (12, 1, 'n', 2, 'impostorDev'),   # lp1 dev probe
+    (13, 1, 'n', 2, 'impostorEval'),  # none
+    (14, 4, 'l', 1, 'client'),        # darkened-lp1 eval probe
+    (15, 4, 'r', 2, 'impostorEval'),  # darkened-lp1 eval probe
+    (16, 4, 'n', 1, 'impostorEval'),  # none
+  ]
+  assert protocol_memberships(purposes, files) == [(1, 10), (2, 11), (2, 12), (3, 14), (3, 15)]
+
+
+def test_create_annotations():
+  # Tests that the annotations are read in parallel from all sub-directories
+  import tempfile, shutil
+  root = tempfile.mkdtemp(prefix='bobtest_')
+  try:
+    images, annotations = synthetic_tree(root)
+    # the second sub-directory only contains the annotations of a single client
+    shutil.copytree(os.path.join(annotations, 'frontal', '003'), os.path.join(annotations, 'second'))
+    results = []
+    for jobs in (1, 4):
+      dbfile = create_synthetic(root, annotdir=annotations, annotsub=['frontal/004', 'second'], jobs=jobs)
+      results.append(table_rows(dbfile, 'SELECT annotation.id, file.path, re_x, re_y, le_x, le_y FROM annotation '
+                                        'JOIN file ON file.id = annotation.file_id ORDER BY annotation.id'))
+    assert results[0] == results[1]
+    assert len(results[0]) == 16
+    # the annotations are added in the order of the sub-directories
+    assert [r[1].split('/')[1] for r in results[0]] == ['004'] * 8 + ['003'] * 8
+    assert results[0][0][2:] == (104, 120, 164, 121)
+  finally:
+    shutil.rmtree(root)
+
+
+def test_update():
+  # Tests that an incremental update gives the same database as a re-creation
+  import tempfile, shutil, argparse
+  from bob.db.xm2vts.create import update
+  root = tempfile.mkdtemp(prefix='bobtest_')
+  try:
+    images, annotations = synthetic_tree(root)
+    dbfile = create_synthetic(root)
+
+    # removes an image, adds a new client and changes an annotation
+    os.unlink(os.path.join(images, 'frontal', '004', '004_2_1.ppm'))
+    synthetic_tree(os.path.join(root, 'new'), clients=(5,))
+    shutil.move(os.path.join(root, 'new', 'images', 'frontal', '005'), os.path.join(images, 'frontal', '005'))
+    shutil.move(os.path.join(root, 'new', 'annotations', 'frontal', '005'), os.path.join(annotations, 'frontal', '005'))
+    with open(os.path.join(annotations, 'frontal', '003', '003_1_1.pos'), 'w') as f:
+      f.write('1 2 3 4\n')
+
+    # counts the annotation files, which are read by the updates
+    import bob.db.xm2vts.create
+    read_annotation_file, reads = bob.db.xm2vts.create.read_annotation_file, []
+    def _counting(filename):
+      reads.append(filename)
+      return read_annotation_file(filename)
+    bob.db.xm2vts.create.read_annotation_file = _counting
+    try:
+      options = argparse.Namespace(type='sqlite', files=[dbfile], verbose=0, imagedir=images,
+                                   annotdir=annotations, annotsub=None, jobs=2, schema_only=False)
+      update(options)
+      # only the modified and the new annotation files are read
+      assert sorted(os.path.relpath(r, annotations) for r in reads) == \
+          sorted([os.path.join('frontal', '003', '003_1_1.pos')] +
+                 [os.path.relpath(os.path.join(d, f), annotations)
+                  for d, _, names in os.walk(annotations) if d.endswith('005') for f in names])
+      del reads[:]
+      update(options)
+      assert reads == []
+    finally:
+      bob.db.xm2vts.create.read_annotation_file = read_annotation_file
+    updated = [table_rows(dbfile, statement) for statement in (
+        'SELECT path, session_id, darkened, shot_id FROM file ORDER BY path',
+        'SELECT path, re_x, re_y, le_x, le_y FROM annotation JOIN file ON file.id = annotation.file_id ORDER BY path',
+        'SELECT protocolPurpose_id, path FROM protocolPurpose_file_association '
+        'JOIN file ON file.id = protocolPurpose_file_association.file_id ORDER BY protocolPurpose_id, path')]
+
+    dbfile = create_synthetic(root)
+    recreated = [table_rows(dbfile, statement) for statement in (
+        'SELECT path, session_id, darkened, shot_id FROM file ORDER BY path',
+        'SELECT path, re_x, re_y, le_x, le_y FROM annotation JOIN file ON file.id = annotation.file_id ORDER BY path',
+        'SELECT protocolPurpose_id, path FROM protocolPurpose_file_association '
+        'JOIN file ON file.id = protocolPurpose_file_association.file_id ORDER BY protocolPurpose_id, path')]
+
+    assert updated == recreated
+    assert ('frontal/003/003_1_1', 1, 2, 3, 4) in updated[1]
+    assert 'frontal/004/004_2_1' not in [r[0] for r in updated[0]]
+    assert 'frontal/005/005_2_1' in [r[0] for r in updated[0]]
+  finally:
+    shutil.rmtree(root)
+
+
+def test_remove_trials():
+  # Tests that create and update remove the cached trials of the database
+  import tempfile, shutil, argparse
+  from bob.db.xm2vts.create import update, trials_file
+  root = tempfile.mkdtemp(prefix='bobtest_')
+  try:
+    images, annotations = synthetic_tree(root)
+    dbfile = create_synthetic(root)
+    for command in (lambda: create_synthetic(root),
+                    lambda: update(argparse.Namespace(type='sqlite', files=[dbfile], verbose=0, imagedir=images,
+                                                      annotdir=annotations, annotsub=None, jobs=1, schema_only=False))):
+      open(trials_file(dbfile, 'lp1', 'dev'), 'w').close()
+      command()
+      assert not os.path.exists(trials_file(dbfile, 'lp1', 'dev'))
+      assert os.path.exists(dbfile)
+  finally:
+    shutil.rmtree(root)
+
+
+def test_query_plans():
+  # Tests that the frequent queries use the indexes instead of scanning the large tables
+  import re, tempfile, shutil, argparse, sqlite3
+  from sqlalchemy import event
+  from bob.db.base.utils import session_try_readonly
+  from bob.db.xm2vts.create import update
+  root = tempfile.mkdtemp(prefix='bobtest_')
+  try:
+    synthetic_tree(root)
+    dbfile = create_synthetic(root)
+
+    # the migration of databases without indexes adds all of them
+    connection = sqlite3.connect(dbfile)
+    indexes = [r[0] for r in connection.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'ix_%'")]
+    assert len(indexes) >= 7
+    for index in indexes:
+      connection.execute('DROP INDEX "%s"' % index)
+    connection.commit()
+    connection.close()
+    update(argparse.Namespace(type='sqlite', files=[dbfile], verbose=0, schema_only=True))
+    assert sorted(r[0] for r in table_rows(dbfile, "SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'ix_%'")) == sorted(indexes)
+
+    # collects the SQL statements of the queries on the synthetic database
+    db = bob.db.xm2vts.Database()
+    db.m_session = session_try_readonly('sqlite', dbfile)
+    statements = []
+    def _collect(conn, cursor, statement, parameters, context, executemany):
+      statements.append((statement, parameters))
+    event.listen(db.m_session.get_bind(), 'before_cursor_execute', _collect)
+    f = db.objects(protocol='lp1', groups='dev', purposes='probe', model_ids=[3])[0]
+    db.objects(protocol='lp2', groups='world')
+    db.objects(protocol='darkened-lp1', groups='eval', classes='client')
+    db.annotations(f)
+    db.annotations_bulk([f])
+    assert len(statements) >= 5
+
+    connection = sqlite3.connect(dbfile)
+    for statement, parameters in statements:
+      for plan in connection.execute('EXPLAIN QUERY PLAN ' + statement, parameters):
+        assert not re.match(r'SCAN (TABLE )?(file|protocolPurpose_file_association|annotation)\b', plan[-1]), (statement, plan)
+    connection.close()
+  finally:
+    shutil.rmtree(root)
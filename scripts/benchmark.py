@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# Copyright (C) 2011-2013 Idiap Research Institute, Martigny, Switzerland
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmarks of the XM2VTS database interface, which are kept out of the test
+suite. Runs all benchmarks, or the ones given on the command line::
+
+  $ python scripts/benchmark.py [startup|import|objects|lookups|trials|dumplist|checkfiles ...]
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+
+def _timed(label, function, *args, **kwargs):
+  """Runs the given function, prints its execution time and returns its result"""
+  start = time.time()
+  retval = function(*args, **kwargs)
+  print("%-40s %8.3f s" % (label, time.time() - start))
+  return retval
+
+
+def bench_startup():
+  """Start-up of the command line and execution time of every subcommand"""
+  from bob.db.base.script.dbmanage import main
+  from bob.db.xm2vts.test import synthetic_tree, create_synthetic
+  from bob.db.xm2vts.create import update, CLIENTS
+
+  code = "import time, argparse; start = time.time(); from bob.db.xm2vts.driver import Interface; " \
+         "Interface().add_commands(argparse.ArgumentParser().add_subparsers()); print(time.time() - start)"
+  elapsed = float(subprocess.check_output([sys.executable, '-c', code]).decode())
+  print("%-40s %8.3f s" % ('add_commands()', elapsed))
+
+  root = tempfile.mkdtemp(prefix='bobbench_')
+  try:
+    for command in ('snapshot -o %s' % os.path.join(root, 'db.snapshot'), 'dumplist --self-test',
+                    'checkfiles --self-test', 'reverse frontal/342/342_2_1 --self-test',
+                    'path 3011 --self-test'):
+      _timed(command.split()[0], main, ('xm2vts ' + command).split())
+
+    # create and update run on a synthetic tree, not on the installed database
+    synthetic_tree(root, [c for group in CLIENTS.values() for c in group])
+    dbfile = _timed('create (synthetic tree)', create_synthetic, root)
+    images, annotations = os.path.join(root, 'images'), os.path.join(root, 'annotations')
+    _timed('update (synthetic tree)', update, argparse.Namespace(
+        type='sqlite', files=[dbfile], verbose=0, imagedir=images, annotdir=annotations,
+        annotsub=None, jobs=1, schema_only=False))
+  finally:
+    shutil.rmtree(root)
+
+
+def bench_dumplist():
+  """dumplist in all output formats"""
+  from bob.db.base.script.dbmanage import main
+  for format in ('newline', 'nul', 'jsonl'):
+    _timed('dumplist --format=%s' % format, main, ('xm2vts dumplist --self-test --format=%s' % format).split())
+
+
+def bench_checkfiles():
+  """checkfiles on a tree of empty images, with different numbers of threads"""
+  import bob.db.xm2vts
+  from bob.db.base.script.dbmanage import main
+  root = tempfile.mkdtemp(prefix='bobbench_')
+  try:
+    for f in bob.db.xm2vts.Database().objects():
+      path = f.make_path(root, '.ppm')
+      if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+      open(path, 'w').close()
+    for jobs in (1, 4, 16):
+      _timed('checkfiles -j %d' % jobs, main, ('xm2vts checkfiles --self-test -d %s -e .ppm -j %d' % (root, jobs)).split())
+  finally:
+    shutil.rmtree(root)
+
+def bench_lookups():
+  """Translations between path stems and file ids"""
+  import bob.db.xm2vts
+  db = bob.db.xm2vts.Database()
+  files = db.objects()
+  stems, ids = [f.path for f in files], [f.id for f in files]
+  _timed('reverse() (200 stems, one at a time)', lambda: [db.reverse([s]) for s in stems[:200]])
+  _timed('reverse_bulk() (%d stems)' % len(stems), db.reverse_bulk, stems)
+  _timed('paths() (%d ids)' % len(ids), db.paths, ids)
+  _timed('paths_bulk() (%d ids)' % len(ids), db.paths_bulk, ids)
+
+
+def bench_trials():
+  """Trial lists, computed and read from the cache on disk"""
+  import bob.db.xm2vts
+  for protocol in ('lp1', 'lp2'):
+    _timed('probe_matrix(%s)' % protocol, bob.db.xm2vts.Database().probe_matrix, protocol)
+    _timed('trial_list(%s)' % protocol, bob.db.xm2vts.Database().trial_list, protocol)
+    _timed('trial_list(%s) (second database)' % protocol, bob.db.xm2vts.Database().trial_list, protocol)
+
+
+def bench_import():
+  """Import time of the package"""
+  code = "import time; start = time.time(); import bob.db.xm2vts; print(time.time() - start)"
+  elapsed = float(subprocess.check_output([sys.executable, '-c', code]).decode())
+  print("%-40s %8.3f s" % ('import bob.db.xm2vts', elapsed))
+
+
+def _objects_per_part(db, **kwargs):
+  """The baseline plan of objects(), which issues one query per part of the request"""
+  files = set()
+  for part in ({'groups': 'world'},
+               {'groups': ('dev', 'eval'), 'purposes': 'enroll'},
+               {'groups': ('dev', 'eval'), 'purposes': 'probe', 'classes': 'client'},
+               {'groups': ('dev', 'eval'), 'purposes': 'probe', 'classes': 'impostor'}):
+    files.update(db.objects(**dict(kwargs, **part)))
+  return files
+
+
+def bench_objects():
+  """objects() with the different back-ends, and the single query against one query per part"""
+  import bob.db.xm2vts
+  from bob.db.xm2vts.test import count_statements
+  for label, kwargs in (('ORM', {}), ('lightweight', {'lightweight': True}), ('index', {'use_index': True})):
+    db = bob.db.xm2vts.Database(**kwargs)
+    db.protocol_names()  # opens the connection
+    _timed('objects() (%s, first call)' % label, db.objects)
+    _timed('objects() (%s, second call)' % label, db.objects)
+
+  db = bob.db.xm2vts.Database()
+  db.protocol_names()
+  for label, function in (('single query', db.objects), ('one query per part', lambda **kwargs: _objects_per_part(db, **kwargs))):
+    with count_statements(db) as statements:
+      _timed('objects(lp1) (%s)' % label, function, protocol='lp1', model_ids=[3])
+    print("%-40s %8d" % ('  statements', len(statements)))
+
+
+BENCHMARKS = dict((name[len('bench_'):], function) for name, function in globals().items() if name.startswith('bench_'))
+
+
+def main(names=None):
+  names = names or sorted(BENCHMARKS)
+  for name in names:
+    print("%s: %s" % (name, BENCHMARKS[name].__doc__))
+    BENCHMARKS[name]()
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))